@@ -0,0 +1,130 @@
+"""Overhead and accuracy of @ratelimited for every algorithm and backend
+
+    python -m tests.bench_ratelimited --duration 2 --concurrency 50 --latency 0.5
+
+Calls the decorated method directly (no http) from `concurrency` clients
+spread over `ips` addresses against LocalRedis, once with a blocking
+client and once with a future returning one. Reports throughput, the
+latency added over an undecorated method, redis commands and round trips
+per request and how many requests were admitted against the budget of
+tokens / refresh per ip. gcra and sliding also allow an initial burst of
+tokens per ip, so short runs read up to one window over for them.
+LocalRedis runs the real lua scripts on fakeredis, the added latency
+includes their (interpreted) execution on top of --latency.
+"""
+import argparse
+from time import time
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import is_future
+
+from tornwrap import ratelimited
+from tornwrap.ratelimited import SharedMemoryBackend
+
+from .local_redis import LocalRedis
+
+
+CONFIGS = (("fixed", lambda options: dict()),
+           ("gcra", lambda options: dict(algorithm="gcra")),
+           ("sliding", lambda options: dict(algorithm="sliding")),
+           ("lease", lambda options: dict(lease=options.lease)),
+           ("batch", lambda options: dict(batch=True)),
+           ("shared-memory", lambda options: dict(backend=SharedMemoryBackend())))
+
+
+class Request(object):
+    def __init__(self, remote_ip):
+        self.remote_ip = remote_ip
+
+
+class Handler(object):
+    """Just enough of a RequestHandler for the decorator"""
+    current_user = None
+
+    def __init__(self, redis, remote_ip):
+        self.redis = redis
+        self.request = Request(remote_ip)
+        self.admitted = False
+
+    def set_header(self, name, value):
+        pass
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        return False
+
+    def get(self):
+        self.admitted = True
+
+
+@gen.coroutine
+def drive(method, redis, options):
+    stats = dict(requests=0, admitted=0, elapsed=0.0)
+    ends = time() + options.duration
+
+    @gen.coroutine
+    def client(n):
+        remote_ip = "10.0.%d.%d" % divmod(n % options.ips, 256)
+        while time() < ends:
+            handler = Handler(redis, remote_ip)
+            started = time()
+            result = method(handler)
+            if is_future(result):
+                yield result
+            stats["elapsed"] += time() - started
+            stats["requests"] += 1
+            stats["admitted"] += handler.admitted
+            if not is_future(result):
+                # let the other clients (and pending batches) run
+                yield gen.moment
+
+    yield [client(n) for n in xrange(options.concurrency)]
+    raise gen.Return(stats)
+
+
+@gen.coroutine
+def run(options):
+    """Returns one row per algorithm/backend and client
+    """
+    baseline = yield drive(Handler.get.im_func, None, options)
+    baseline = baseline["elapsed"] / max(baseline["requests"], 1)
+    budget = options.ips * options.tokens * options.duration / float(options.refresh)
+
+    rows = []
+    for name, config in CONFIGS:
+        for futures in ((False, ) if name == "shared-memory" else (False, True)):
+            redis = LocalRedis(latency=options.latency / 1000.0, futures=futures)
+            method = ratelimited(guest=(options.tokens, options.refresh), **config(options))(Handler.get.im_func)
+            stats = yield drive(method, redis, options)
+            requests = max(stats["requests"], 1)
+            rows.append(dict(name=name,
+                             client="futures" if futures else "blocking",
+                             throughput=stats["requests"] / options.duration,
+                             added=(stats["elapsed"] / requests - baseline) * 1000000,
+                             commands=redis.commands / float(requests),
+                             round_trips=redis.round_trips / float(requests),
+                             admitted=stats["admitted"],
+                             budget=budget,
+                             error=(stats["admitted"] - budget) / budget * 100))
+    raise gen.Return(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--duration", type=float, default=2, help="seconds per run")
+    parser.add_argument("--concurrency", type=int, default=50, help="clients in flight")
+    parser.add_argument("--ips", type=int, default=10, help="distinct client addresses")
+    parser.add_argument("--tokens", type=int, default=100, help="tokens per ip")
+    parser.add_argument("--refresh", type=int, default=1, help="seconds per window")
+    parser.add_argument("--lease", type=int, default=10, help="tokens per lease")
+    parser.add_argument("--latency", type=float, default=0.5, help="redis round trip in ms")
+    options = parser.parse_args()
+
+    rows = IOLoop.current().run_sync(lambda: run(options))
+    print "%-14s %-9s %10s %12s %9s %12s %9s %9s %8s" % ("backend", "client", "req/s", "added us/req", "cmds/req",
+                                                         "trips/req", "admitted", "budget", "error")
+    for row in rows:
+        print "%(name)-14s %(client)-9s %(throughput)10.0f %(added)12.1f %(commands)9.3f %(round_trips)12.3f %(admitted)9d %(budget)9.0f %(error)+7.1f%%" % row
+
+
+if __name__ == "__main__":
+    main()
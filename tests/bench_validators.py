@@ -0,0 +1,69 @@
+"""Cost of the date validators' ISO-8601 / epoch path against timestring
+
+    python -m tests.bench_validators --number 2000
+
+Times parse_date and parse_range against timestring.Date and
+timestring.Range for machine formats (which take the fast path) and
+free text (which falls back to timestring, shown with the parse cache
+on and off). Reports microseconds per call and the speedup.
+"""
+import argparse
+import timestring
+from timeit import timeit
+
+from tornwrap.validators import parse_date
+from tornwrap.validators import parse_range
+from tornwrap.validators import timestring_cache
+
+
+INPUTS = (("iso date", "2015-01-15"),
+          ("iso datetime", "2015-01-15T10:30:00"),
+          ("iso datetime Z", "2015-01-15T10:30:00Z"),
+          ("epoch", "1421318400"),
+          ("epoch int", 1421318400),
+          ("free text", "last tuesday"))
+
+RANGES = (("iso date", "2015-01-15T10:30:00"),
+          ("iso start,end", "2015-01-15,2015-01-20T12:00:00"),
+          ("epoch", "1421318400"),
+          ("free text", "last 7 days"))
+
+
+def measure(function, value, number, cached=True):
+    resolution = timestring_cache.resolution
+    if not cached:
+        # a new time bucket on every call
+        timestring_cache.resolution = 0.000000001
+    try:
+        return timeit(lambda: function(value), number=number) / number * 1000000
+    finally:
+        timestring_cache.resolution = resolution
+
+
+def run(options):
+    """Returns one row per input and parser
+    """
+    rows = []
+    for kind, fast, slow, inputs in (("date", parse_date, timestring.Date, INPUTS),
+                                     ("range", parse_range, timestring.Range, RANGES)):
+        for name, value in inputs:
+            baseline = measure(slow, value, options.number)
+            for cached in ((True, False) if name == "free text" else (True, )):
+                took = measure(fast, value, options.number, cached)
+                rows.append(dict(kind=kind, name=name + ("" if cached else " (uncached)"),
+                                 timestring=baseline, fast=took, speedup=baseline / took))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--number", type=int, default=2000, help="calls per measurement")
+    options = parser.parse_args()
+
+    print "%-6s %-24s %14s %14s %8s" % ("kind", "input", "timestring us", "validators us", "speedup")
+    for row in run(options):
+        print "%(kind)-6s %(name)-24s %(timestring)14.1f %(fast)14.1f %(speedup)7.1fx" % row
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from time import sleep
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+import fakeredis
+
+
+class LocalRedis(object):
+    """In-process redis for the commands the rate limiters send
+
+    Commands run on fakeredis, which executes the limiter's own lua scripts
+    (with lupa), so results are those of the production scripts. Every
+    round trip waits `latency` seconds, blocking like redis-py or, with
+    `futures=True`, resolving a future on the IOLoop like an async client.
+    `commands` and `round_trips` count what would have been sent to redis.
+    """
+    def __init__(self, latency=0, futures=False):
+        self.latency = latency
+        self.futures = futures
+        self.commands = 0
+        self.round_trips = 0
+        # a server of its own, instances do not share keys or scripts
+        self.redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+
+    def flushall(self):
+        self.redis.flushall()
+
+    def evalsha(self, sha, numkeys, *args):
+        return self._reply(1, self.redis.evalsha, sha, numkeys, *args)
+
+    def eval(self, script, numkeys, *args):
+        return self._reply(1, self.redis.eval, script, numkeys, *args)
+
+    def get(self, key):
+        return self._reply(1, self.redis.get, key)
+
+    def zrem(self, key, member):
+        return self._reply(1, self.redis.zrem, key, member)
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def _reply(self, commands, command, *args):
+        self.commands += commands
+        self.round_trips += 1
+        if not self.futures:
+            if self.latency:
+                sleep(self.latency)
+            return command(*args)
+
+        future = Future()
+
+        def resolve():
+            try:
+                future.set_result(command(*args))
+            except Exception as e:
+                future.set_exception(e)
+        IOLoop.current().call_later(self.latency, resolve)
+        return future
+
+
+class Pipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.pipeline = redis.redis.pipeline(transaction=False)
+        self.size = 0
+
+    def evalsha(self, sha, numkeys, *args):
+        self.pipeline.evalsha(sha, numkeys, *args)
+        self.size += 1
+
+    def execute(self, raise_on_error=True):
+        return self.redis._reply(self.size, self.pipeline.execute, raise_on_error)
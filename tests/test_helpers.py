@@ -25,3 +25,30 @@ class Test(unittest.TestCase):
         now = timestring.Date('now')
         self.assertEqual(json_encode(dict(data=now)),
                          '{"data": "%s"}' % str(now))
+
+    def test_query_arguments(self):
+        class Request(object):
+            query_arguments = {"a": ["1"], "b": ["2", "3"], "c": [""], "_": ["1417978116609"],
+                               "_private": ["x"], "access_token": ["abc123"], "": ["1"]}
+
+        request = Request()
+        query = query_arguments(request)
+        self.assertEqual(query, {"a": "1", "b": ["2", "3"], "": "1"})
+        self.assertIs(query.raw, request.query_arguments)
+        # built once per request
+        self.assertIs(query_arguments(request), query)
+
+    def test_lru_cache(self):
+        calls = []
+        cache = LRUCache(lambda value: calls.append(value) or [value],
+                         lambda value: value if value != "skip" else None, copy=list, size=2)
+        self.assertEqual(cache.get("a"), ["a"])
+        cache.get("a")[0] = "changed"
+        self.assertEqual(cache.get("a"), ["a"])
+        cache.get("b")
+        cache.get("c")  # evicts a
+        cache.get("skip")
+        cache.get("skip")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(calls, ["a", "b", "c", "skip", "skip"])
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
@@ -1,9 +1,26 @@
 import time
 import redis
+import logging
+import unittest
+from argparse import Namespace
+from multiprocessing import Process
+from tornado import gen
+from tornado.ioloop import IOLoop
 from tornado.web import Application
+from tornado.concurrent import Future
+from tornado.testing import gen_test
 from tornado.testing import AsyncHTTPTestCase
 
 from tornwrap import ratelimited
+from tornwrap import concurrency_limited
+from tornwrap.ratelimited import NetworkPolicy
+from tornwrap.ratelimited import LoadMonitor
+from tornwrap.ratelimited import CircuitBreaker
+from tornwrap.ratelimited import LeaseTable
+from tornwrap.ratelimited import SharedMemoryBackend
+from tornwrap.ratelimited import _release
+
+from .bench_ratelimited import run
 from tornwrap.handler import RequestHandler
 
 
@@ -45,11 +62,310 @@ class HandlerNoCallback(RequestHandler):
         return self.request.headers.get('X-User') == 'yes'
 
 
+class AsyncRedis(object):
+    """Returns futures like a non-blocking client would"""
+    def __init__(self, redis):
+        self._redis = redis
+
+    def __getattr__(self, name):
+        def call(*args):
+            future = Future()
+            try:
+                future.set_result(getattr(self._redis, name)(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return call
+
+
+class HandlerAsync(RequestHandler):
+    def initialize(self, redis):
+        self.redis = AsyncRedis(redis)
+
+    @ratelimited(guest=(5, 2))
+    @gen.coroutine
+    def get(self):
+        yield gen.moment
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class HandlerLease(RequestHandler):
+    def initialize(self, redis):
+        self.redis = redis
+
+    @ratelimited(guest=(5, 2), lease=3)
+    def get(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class HandlerBatch(RequestHandler):
+    def initialize(self, redis):
+        self.redis = redis
+
+    @ratelimited(guest=(5, 2), batch=True)
+    def get(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class HandlerAlgorithm(RequestHandler):
+    def initialize(self, redis):
+        self.redis = redis
+
+    @ratelimited(guest=(5, 2), algorithm="gcra")
+    def get(self):
+        self.write("Hello, world!")
+
+    @ratelimited(guest=(5, 2), algorithm="sliding")
+    def post(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class BrokenRedis(object):
+    def evalsha(self, *args):
+        raise redis.ConnectionError("Connection refused")
+
+    def zrem(self, *args):
+        raise redis.ConnectionError("Connection refused")
+
+
+class HandlerBreaker(RequestHandler):
+    fail_open = CircuitBreaker(failures=2, cooldown=60)
+    fail_closed = CircuitBreaker(failures=2, cooldown=60, fail_open=False)
+
+    def initialize(self, redis):
+        self.redis = BrokenRedis()
+
+    @ratelimited(guest=(5, 2), breaker=fail_open)
+    def get(self):
+        self.write("Hello, world!")
+
+    @ratelimited(guest=(5, 2), breaker=fail_closed)
+    def post(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class HandlerSharedMemory(RequestHandler):
+    @ratelimited(guest=(5, 2), backend=SharedMemoryBackend(slots=16, ways=4))
+    def get(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class TestLeaseTable(unittest.TestCase):
+    def test_concurrent_leases(self):
+        leases = LeaseTable(5)
+        # two leases for one key resolved back to back (async clients), neither is lost
+        self.assertEqual(leases.store("k", 5, 5, 10), (9, 10))
+        self.assertEqual(leases.store("k", 5, 0, 10), (8, 10))
+        for x in xrange(8):
+            self.assertEqual(leases.take("k")[0], 7 - x)
+        self.assertEqual(leases.take("k")[0], -1)
+
+    def test_max_keys(self):
+        leases = LeaseTable(5)
+        leases.max_keys = 10
+        for x in xrange(25):
+            self.assertEqual(leases.store("ip.%d" % x, 5, 5, 60), (9, 60))
+        self.assertEqual(len(leases.leases), 10)
+        # the oldest leases made room
+        self.assertIsNone(leases.take("ip.14"))
+        self.assertEqual(leases.take("ip.24")[0], 8)
+
+
+class TestRelease(unittest.TestCase):
+    def test_async_failure_logged(self):
+        class Handler(object):
+            redis = AsyncRedis(BrokenRedis())
+
+        class Logged(logging.Handler):
+            records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        log, logged, finished = logging.getLogger('tornado'), Logged(), []
+        log.addHandler(logged)
+        try:
+            _release(Handler(), "concurrency.key", "lease", lambda: finished.append(True))
+        finally:
+            log.removeHandler(logged)
+        self.assertEqual(finished, [True])
+        # the traceback, not tornado.application's "never retrieved" warning
+        records = [record for record in logged.records if record.name == 'tornado']
+        self.assertEqual(len(records), 1)
+        self.assertIn("Connection refused", records[0].getMessage())
+
+
+class TestSharedMemory(unittest.TestCase):
+    def test_shared_across_fork(self):
+        backend = SharedMemoryBackend(slots=16, ways=4)
+        self.assertEqual(backend.check("a", 5, 60), (4, 60))
+        child = Process(target=backend.check, args=("a", 5, 60))
+        child.start()
+        child.join()
+        self.assertEqual(backend.check("a", 5, 60), (2, 60))
+
+    def test_evicts(self):
+        backend = SharedMemoryBackend(slots=4, ways=4)
+        for key in "abcd":
+            backend.check(key, 5, 60)
+        backend.check("a", 5, 60)
+        backend.check("e", 5, 60)
+        self.assertEqual(backend.check("a", 5, 60)[0], 2)
+        self.assertEqual(backend.check("b", 5, 60)[0], 4)
+
+
+class HandlerNetworks(RequestHandler):
+    def initialize(self, redis):
+        self.redis = redis
+
+    @ratelimited(guest=(5, 2), networks=NetworkPolicy({"127.0.0.0/8": "exempt"}))
+    def get(self):
+        self.write("Hello, world!")
+
+    @ratelimited(guest=(5, 2), networks=NetworkPolicy({"127.0.0.1": "deny"}))
+    def post(self):
+        self.write("Hello, world!")
+
+    @ratelimited(guest=(5, 2), networks=NetworkPolicy({"127.0.0.0/8": dict(guest=(1, 2))}))
+    def put(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class TestNetworkPolicy(unittest.TestCase):
+    def test_longest_prefix(self):
+        policy = NetworkPolicy([("10.0.0.0/8", "exempt"),
+                                ("10.1.0.0/16", (10, 60)),
+                                ("10.1.2.3/32", "deny"),
+                                ("2001:db8::/32", dict(user=(5, 60))),
+                                ("0.0.0.0/0", (1, 60))])
+        self.assertEqual(policy.lookup("10.200.0.1"), "exempt")
+        self.assertEqual(policy.lookup("10.1.200.1"), ((10, 60), (10, 60)))
+        self.assertEqual(policy.lookup("10.1.2.3"), "deny")
+        self.assertEqual(policy.lookup("::ffff:10.1.2.3"), "deny")
+        self.assertEqual(policy.lookup("192.168.0.1"), ((1, 60), (1, 60)))
+        self.assertEqual(policy.lookup("2001:db8::1"), ((5, 60), (None, None)))
+        self.assertEqual(policy.lookup("2001:db9::1"), None)
+        self.assertEqual(policy.lookup("not-an-ip"), None)
+
+    def test_invalid(self):
+        self.assertRaises(AssertionError, NetworkPolicy, {"10.0.0.0/33": "exempt"})
+        self.assertRaises(AssertionError, NetworkPolicy, {"10.0.0.0/8": (0, 60)})
+
+    def test_empty(self):
+        self.assertIsNone(NetworkPolicy({}).lookup("10.1.2.3"))
+
+
+class HandlerAdaptive(RequestHandler):
+    monitor = LoadMonitor()
+    # not ticking, budgets are set by the test
+    monitor.started = True
+
+    def initialize(self, redis):
+        self.redis = redis
+
+    @ratelimited(guest=(5, 2), adaptive=monitor)
+    def get(self):
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class TestLoadMonitor(unittest.TestCase):
+    def test_sheds_guests_first(self):
+        monitor = LoadMonitor(max_lag=50, max_latency=500, floor=0.1)
+        monitor.started = True
+        monitor.update()
+        self.assertEqual((monitor.scale(100, False), monitor.scale(100, True)), (100, 100))
+
+        monitor.lag = 0.1
+        monitor.update()
+        self.assertEqual((monitor.scale(100, False), monitor.scale(100, True)), (50, 100))
+
+        monitor.observe(2.0)
+        monitor.update()
+        self.assertEqual((monitor.scale(100, False), monitor.scale(100, True)), (25, 50))
+
+        monitor.lag = 10
+        monitor.update()
+        self.assertEqual((monitor.scale(100, False), monitor.scale(5, True)), (10, 1))
+
+        monitor.lag = 0
+        monitor.latencies.clear()
+        monitor.update()
+        self.assertEqual((monitor.scale(100, False), monitor.scale(100, True)), (100, 100))
+
+
+class HandlerConcurrency(RequestHandler):
+    def initialize(self, redis):
+        self.redis = redis
+
+    @concurrency_limited(guest=2)
+    @gen.coroutine
+    def get(self):
+        yield gen.sleep(0.2)
+        self.write("Hello, world!")
+
+    def was_rate_limited(self, tokens, remaining, ttl):
+        self.set_status(403)
+        self.finish("Rate Limited")
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        options = Namespace(duration=0.2, concurrency=4, ips=2, tokens=10, refresh=1, lease=5, latency=0)
+        rows = IOLoop().run_sync(lambda: run(options))
+        self.assertEqual(len(rows), 11)
+        for row in rows:
+            if row["name"] in ("fixed", "lease", "batch", "shared-memory"):
+                self.assertEqual(row["admitted"], 20)
+            if row["name"] in ("lease", "shared-memory"):
+                self.assertLess(row["commands"], 0.1)
+
+
 class TestRateLimit(AsyncHTTPTestCase):
     redis = redis.Redis()
 
     def get_app(self):
         return Application([('/', Handler, dict(redis=self.redis)),
+                            ('/async', HandlerAsync, dict(redis=self.redis)),
+                            ('/lease', HandlerLease, dict(redis=self.redis)),
+                            ('/batch', HandlerBatch, dict(redis=self.redis)),
+                            ('/algorithm', HandlerAlgorithm, dict(redis=self.redis)),
+                            ('/breaker', HandlerBreaker, dict(redis=self.redis)),
+                            ('/shared-memory', HandlerSharedMemory),
+                            ('/networks', HandlerNetworks, dict(redis=self.redis)),
+                            ('/adaptive', HandlerAdaptive, dict(redis=self.redis)),
+                            ('/concurrency', HandlerConcurrency, dict(redis=self.redis)),
                             ('/no-callback', HandlerNoCallback, dict(redis=self.redis))])
 
     def test_ratelimit_1(self):
@@ -64,6 +380,100 @@ class TestRateLimit(AsyncHTTPTestCase):
     def test_ratelimit_4(self):
         self.ratelimit(1, method="PUT", body="")
 
+    def test_ratelimit_async(self):
+        self.ratelimit(5, url="/async")
+
+    def test_ratelimit_lease(self):
+        self.ratelimit(5, url="/lease")
+
+    def test_ratelimit_batch(self):
+        self.ratelimit(5, url="/batch")
+
+    def test_batch_script_reloaded(self):
+        self.redis.flushall()
+        self.redis.script_flush()
+        self.assertEqual(self.fetch("/batch").headers.get("X-RateLimit-Remaining"), "4")
+
+    def test_ratelimit_gcra(self):
+        self.ratelimit(5, url="/algorithm")
+
+    def window_start(self, refresh=2):
+        # the sliding windows are aligned on the clock, start the requests in a fresh one
+        time.sleep(refresh - time.time() % refresh)
+
+    def test_ratelimit_sliding(self):
+        self.redis.flushall()
+        self.window_start()
+        for x in xrange(1, 8):
+            response = self.fetch("/algorithm", method="POST", body="")
+            self.assertEqual(response.headers.get("X-RateLimit-Remaining"), str(max(5 - x, 0)))
+            self.assertEqual(response.code, 200 if x <= 5 else 403)
+
+    def test_mixed_algorithms(self):
+        # each algorithm keeps its own keys for one ip
+        self.redis.flushall()
+        self.window_start()
+        self.assertEqual(self.fetch("/algorithm").headers.get("X-RateLimit-Remaining"), "4")
+        self.assertEqual(self.fetch("/").headers.get("X-RateLimit-Remaining"), "4")
+        self.assertEqual(self.fetch("/algorithm", method="POST", body="").headers.get("X-RateLimit-Remaining"), "4")
+        self.assertEqual(self.fetch("/algorithm").headers.get("X-RateLimit-Remaining"), "3")
+        self.assertEqual(self.fetch("/").headers.get("X-RateLimit-Remaining"), "3")
+
+    def test_algorithm(self):
+        self.assertRaises(AssertionError, ratelimited, guest=(5, 2), algorithm="leaky")
+        self.assertRaises(AssertionError, ratelimited, guest=(5, 2), algorithm="gcra", lease=2)
+        self.assertRaises(AssertionError, ratelimited, guest=(5, 2), algorithm="sliding", backend=SharedMemoryBackend())
+
+    def test_breaker_fail_open(self):
+        for x in xrange(3):
+            response = self.fetch("/breaker")
+            self.assertEqual(response.code, 200)
+            self.assertNotIn("X-RateLimit-Remaining", response.headers)
+        self.assertEqual(HandlerBreaker.fail_open.state, "open")
+
+    def test_breaker_fail_closed(self):
+        for x in xrange(3):
+            response = self.fetch("/breaker", method="POST", body="")
+            self.assertEqual(response.code, 403)
+        self.assertEqual(HandlerBreaker.fail_closed.state, "open")
+        self.assertEqual(response.headers.get("X-RateLimit-Remaining"), "0")
+        self.assertEqual(response.headers.get("X-RateLimit-Reset"), "60")
+
+    def test_ratelimit_shared_memory(self):
+        self.ratelimit(5, url="/shared-memory")
+
+    def test_ratelimit_networks(self):
+        self.ratelimit(1, url="/networks", method="PUT", body="")
+
+    def test_networks_exempt(self):
+        for x in xrange(7):
+            response = self.fetch("/networks")
+            self.assertEqual(response.code, 200)
+            self.assertNotIn("X-RateLimit-Limit", response.headers)
+
+    def test_networks_deny(self):
+        response = self.fetch("/networks", method="POST", body="")
+        self.assertEqual(response.code, 403)
+        self.assertEqual(response.headers.get("X-RateLimit-Limit"), "0")
+
+    def test_ratelimit_adaptive(self):
+        HandlerAdaptive.monitor.guest = 0.4
+        self.ratelimit(2, url="/adaptive")
+
+    @gen_test
+    def test_concurrency(self):
+        self.redis.flushall()
+        responses = yield [self.http_client.fetch(self.get_url("/concurrency"), raise_error=False) for x in xrange(3)]
+        self.assertEqual(sorted(response.code for response in responses), [200, 200, 403])
+        self.assertEqual(self.redis.zcard("concurrency.127.0.0.1"), 0)
+        response = yield self.http_client.fetch(self.get_url("/concurrency"), raise_error=False)
+        self.assertEqual(response.code, 200)
+
+    def test_concurrency_expired(self):
+        self.redis.flushall()
+        self.redis.execute_command("ZADD", "concurrency.127.0.0.1", 1, "crashed-1", 2, "crashed-2")
+        self.assertEqual(self.fetch("/concurrency").code, 200)
+
     def test_no_callback(self):
         self.ratelimit(5, False, method="GET", headers={"X-User": "yes"}, url="/no-callback")
         response = self.fetch("/no-callback")
@@ -72,6 +482,13 @@ class TestRateLimit(AsyncHTTPTestCase):
         self.assertNotIn("X-RateLimit-Remaining", response.headers)
         self.assertNotIn("X-RateLimit-Reset", response.headers)
 
+    def test_script_reloaded(self):
+        self.redis.flushall()
+        self.assertEqual(self.fetch("/").headers.get("X-RateLimit-Remaining"), "4")
+        self.redis.script_flush()
+        self.assertEqual(self.fetch("/").headers.get("X-RateLimit-Remaining"), "3")
+        self.assertEqual(self.fetch("/").headers.get("X-RateLimit-Remaining"), "2")
+
     def ratelimit(self, tokens, caught=True, url="/", **kwargs):
         self.redis.flushall()
         for again in (1, 1, 0):
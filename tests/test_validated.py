@@ -1,9 +1,21 @@
+import json
+import zlib
+import gzip
 import valideer
+from StringIO import StringIO
 from tornado.web import Application
+from tornado.web import stream_request_body
 from tornado.web import RequestHandler
+from tornado.httputil import HTTPFile
 from tornado.testing import AsyncHTTPTestCase
 
 from tornwrap import validated
+from tornwrap.validated import DECODERS
+from tornwrap.validated import ValidationProfile
+from tornwrap.compiler import compile_schema
+from tornwrap.compiler import CompiledObject
+from tornwrap.streaming import JSONStream
+from tornwrap.streaming import StreamedBody
 
 
 class Handler(RequestHandler):
@@ -32,9 +44,110 @@ class Handler(RequestHandler):
             super(Handler, self)._handle_request_exception(e)
 
 
+class CompiledHandler(Handler):
+    @validated({"+name": valideer.Enum(("steve", "joe")), "id": "id", "joe": "bool"}, compiled=True)
+    def get(self, arguments):
+        self.finish("Hello, %s %s %s!" % (arguments['name'], arguments.get('id'), arguments.get('joe')))
+
+    @validated(body={"name": valideer.Enum(("steve", "joe")), "tags": ["string"]}, compiled=True)
+    def post(self, body):
+        self.finish("Hello, %s!" % body.get('name', 'nobody'))
+
+
+def gzipped(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class BatchHandler(Handler):
+    @validated(body={"+id": "id", "name": "string"}, many=True)
+    def post(self, body, errors):
+        self.report(body, errors)
+
+    def report(self, body, errors):
+        self.finish({"ids": [record["id"] for record in body],
+                     "errors": dict((index, str(error)) for index, error in errors.items())})
+
+
+class UploadHandler(Handler):
+    @validated(body={"+name": "string", "+upload": valideer.Type(HTTPFile)})
+    def put(self, body):
+        self.finish("%s %s %d" % (body['name'], body['upload'].filename, len(body['upload'].body)))
+
+
+class CompressedHandler(Handler):
+    @validated(body={"name": valideer.Enum(("steve", "joe")), "pad": "string"}, max_body_size=1000)
+    def post(self, body):
+        self.finish("Hello, %s!" % body.get('name', 'nobody'))
+
+
+@stream_request_body
+class StreamedBatchHandler(StreamedBody, BatchHandler):
+    @validated(body={"+id": "id", "name": "string"}, many=True, streamed=True)
+    def post(self, body, errors):
+        self.report(body, errors)
+
+
+@stream_request_body
+class StreamedHandler(StreamedBody, Handler):
+    @validated(body={"+name": "string", "items": [{"+id": "int"}]}, streamed=True, max_body_size=100000)
+    def post(self, body):
+        self.finish("Hello, %s %d!" % (body['name'], len(body.get('items', []))))
+
+    spool_size = 1024
+
+    @validated(body={"+name": "string", "+upload": valideer.Type(HTTPFile)}, streamed=True)
+    def put(self, body):
+        upload = body['upload']
+        self.finish("%s %s %d %s %s %d" % (body['name'], upload.filename, upload.size,
+                                           upload.file._rolled, len(upload.file.read()), len(upload.body)))
+
+
+class BufferedHandler(StreamedBody, Handler):
+    # streamed=True without @stream_request_body
+    @validated(body={"+name": "string"}, streamed=True)
+    def post(self, body):
+        self.finish("Hello, %s!" % body['name'])
+
+
+profile = ValidationProfile(log=True)
+
+
+class ProfiledHandler(Handler):
+    @validated(arguments={"id": "id"}, body={"+name": "string", "user": {"email": "email", "age": valideer.Nullable("int", 0)}},
+               compiled=True, profile=profile)
+    def post(self, arguments, body):
+        self.finish({"body": body, "log": self._log_validation})
+
+
+@stream_request_body
+class StreamedProfiledHandler(StreamedBody, Handler):
+    @validated(body={"+name": "string", "items": [{"+id": "int"}]}, streamed=True, profile=profile)
+    def post(self, body):
+        self.finish({"body": body, "log": self._log_validation})
+
+
+class CachedHandler(Handler):
+    @validated({"+name": valideer.Enum(("steve", "joe")), "ids": "ints", "joe": "bool"}, cache=2)
+    def get(self, arguments):
+        self.finish({"name": arguments["name"], "ids": list(arguments.get("ids", [])), "joe": arguments.get("joe")})
+        # handlers can not change the cache
+        arguments["ids"].append(0)
+
+
 class Test(AsyncHTTPTestCase):
     def get_app(self):
-        return Application([('/', Handler)])
+        return Application([('/', Handler), ('/compiled', CompiledHandler), ('/streamed', StreamedHandler),
+                            ('/compressed', CompressedHandler),
+                            ('/upload', UploadHandler),
+                            ('/batch', BatchHandler),
+                            ('/streamed/batch', StreamedBatchHandler),
+                            ('/profiled', ProfiledHandler),
+                            ('/cached', CachedHandler),
+                            ('/buffered', BufferedHandler),
+                            ('/streamed/profiled', StreamedProfiledHandler)])
 
     def test_missing(self):
         response = self.fetch("/")
@@ -88,3 +201,201 @@ class Test(AsyncHTTPTestCase):
     def test_initial_values(self):
         self.assertRaises(ValueError, validated, arguments=True)
         self.assertRaises(ValueError, validated, body=True)
+
+    def test_compiled(self):
+        response = self.fetch("/compiled?name=joe&id=5&joe=t")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "Hello, joe 5 True!")
+        self.assertEqual(self.fetch("/compiled?name=andy").code, 400)
+        self.assertEqual(self.fetch("/compiled?name=joe&id=0").code, 400)
+        self.assertEqual(self.fetch("/compiled", method="POST", body='{"name": "steve", "tags": ["a"]}').body, "Hello, steve!")
+        self.assertEqual(self.fetch("/compiled", method="POST", body='{"tags": [1]}').code, 400)
+
+    def test_compiled_matches(self):
+        schema = valideer.parse({"+name": "string", "id": "id", "ok": "bool", "email": "email",
+                                 "size": "int", "nested": {"+x": "float"}}, additional_properties=False)
+        compiled = compile_schema(schema)
+        self.assertIsInstance(compiled, CompiledObject)
+        self.assertIsInstance(compiled.validate({"name": "a"}), dict)
+        for value in ({"name": "a", "id": "5", "ok": "yes", "email": "A@B.CO", "size": "10", "nested": {"x": 1}},
+                      {"name": 1}, {"id": "5"}, {"name": "a", "id": "0"}, {"name": "a", "ok": "maybe"},
+                      {"name": "a", "nested": {}}, {"name": "a", "other": 1}, "name", None):
+            try:
+                expected = schema.validate(value)
+            except valideer.ValidationError as e:
+                with self.assertRaises(valideer.ValidationError) as context:
+                    compiled.validate(value)
+                self.assertEqual(str(context.exception), str(e))
+            else:
+                self.assertEqual(compiled.validate(value), expected)
+        self.assertIs(compile_schema(valideer.parse("string")).__class__, valideer.String)
+
+    def test_streamed(self):
+        body = json.dumps({"name": "joe", "items": [{"id": n} for n in range(1000)]})
+        response = self.fetch("/streamed", method="POST", body=body)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "Hello, joe 1000!")
+        self.assertEqual(self.fetch("/streamed", method="POST", body='{"items": [{"id": "a"}]}').code, 400)
+        self.assertEqual(self.fetch("/streamed", method="POST", body='{"items": []}').code, 400)
+        self.assertEqual(self.fetch("/streamed", method="POST", body='{"name": "joe",').code, 400)
+        # nothing is streamed for an empty body, {} is validated
+        response = self.fetch("/streamed", method="POST", body='')
+        self.assertEqual(response.code, 400)
+        self.assertIn("missing required properties: ['name']", response.reason)
+
+    def test_streamed_buffered(self):
+        response = self.fetch("/buffered", method="POST", body='{"name": "joe"}')
+        self.assertEqual(response.body, "Hello, joe!")
+        self.assertEqual(self.fetch("/buffered", method="POST", body='name=joe').body, "Hello, joe!")
+        self.assertEqual(self.fetch("/buffered", method="POST", body='{"name": 1}').code, 400)
+        self.assertEqual(self.fetch("/buffered", method="POST", body='').code, 400)
+
+    def test_streamed_chunks(self):
+        schema = valideer.parse({"+name": "string", "items": ["int"], "tags": {"a": "bool"}})
+        text = '{"name": "j\\"o,e}", "items": [1, 2, 3], "tags": {"a": true}, "more": [{"x": "]"}]}'
+        for size in (1, 2, 7, len(text)):
+            stream = JSONStream(schema)
+            for i in range(0, len(text), size):
+                stream.feed(text[i:i + size])
+            self.assertEqual(stream.close(), schema.validate(json.loads(text)))
+
+        stream = JSONStream(schema)
+        with self.assertRaises(valideer.ValidationError) as context:
+            stream.feed('{"name": "joe", "items": [1, "a", ')
+        self.assertEqual(context.exception.context, [1, "items"])
+
+    def test_content_types(self):
+        multipart = ('--BOUNDARY\r\nContent-Disposition: form-data; name="name"\r\n\r\njoe\r\n--BOUNDARY--\r\n')
+        response = self.fetch("/", method="POST", body=multipart,
+                              headers={"Content-Type": "multipart/form-data; boundary=BOUNDARY"})
+        self.assertEqual(response.body, "Hello, joe!")
+        response = self.fetch("/", method="POST", body='{"name": "joe"}', headers={"Content-Type": "application/json"})
+        self.assertEqual(response.body, "Hello, joe!")
+        self.assertEqual(self.fetch("/", method="POST", body='name=joe', headers={"Content-Type": "application/json"}).code, 400)
+        response = self.fetch("/", method="POST", body='name=joe', headers={"Content-Type": "text/plain"})
+        self.assertEqual(response.body, "Hello, joe!")
+        # json posted as a form, ex. `curl -d`
+        response = self.fetch("/", method="POST", body='\n {"name": "joe"}', headers={"Content-Type": "application/x-www-form-urlencoded"})
+        self.assertEqual(response.body, "Hello, joe!")
+
+    def test_custom_decoder(self):
+        DECODERS["text/csv"] = lambda request: dict(zip(("name", ), request.body.split(",")))
+        try:
+            response = self.fetch("/", method="POST", body='steve,', headers={"Content-Type": "text/csv"})
+            self.assertEqual(response.body, "Hello, steve!")
+        finally:
+            del DECODERS["text/csv"]
+
+    def test_streamed_multipart(self):
+        body = ('--BOUNDARY\r\nContent-Disposition: form-data; name="name"\r\n\r\njoe\r\n'
+                '--BOUNDARY\r\nContent-Disposition: form-data; name="upload"; filename="a.bin"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n' + "x" * 100000 + '\r\n--BOUNDARY--\r\n')
+        headers = {"Content-Type": "multipart/form-data; boundary=BOUNDARY"}
+        response = self.fetch("/streamed", method="PUT", body=body, headers=headers)
+        self.assertEqual(response.body, "joe a.bin 100000 True 100000 100000")
+        self.assertEqual(self.fetch("/streamed", method="PUT", body=body.replace("joe", ""), headers=headers).code, 200)
+        self.assertEqual(self.fetch("/streamed", method="PUT", body=body[:200], headers=headers).code, 400)
+        self.assertEqual(self.fetch("/streamed", method="PUT", body=body.replace('name="name"', 'name="nom"'), headers=headers).code, 400)
+
+        # files are validated with the fields, streamed or not
+        self.assertEqual(self.fetch("/upload", method="PUT", body=body, headers=headers).body, "joe a.bin 100000")
+        body = body.replace("x" * 100000, "x")
+        for _body in (body.replace('name="upload"', 'name="other"'),
+                      body.replace('--BOUNDARY--', '--BOUNDARY\r\nContent-Disposition: form-data; name="more"; '
+                                                   'filename="b.bin"\r\n\r\ny\r\n--BOUNDARY--')):
+            for url in ("/streamed", "/upload"):
+                self.assertEqual(self.fetch(url, method="PUT", body=_body, headers=headers).code, 400)
+
+    def test_compressed(self):
+        body = '{"name": "joe"}'
+        for encoding, data in (("gzip", gzipped(body)), ("deflate", zlib.compress(body)), ("deflate", zlib.compress(body)[2:-4])):
+            response = self.fetch("/compressed", method="POST", body=data, headers={"Content-Encoding": encoding})
+            self.assertEqual(response.body, "Hello, joe!")
+        response = self.fetch("/compressed", method="POST", body=gzipped("name=steve"),
+                              headers={"Content-Encoding": "gzip", "Content-Type": "application/x-www-form-urlencoded"})
+        self.assertEqual(response.body, "Hello, steve!")
+        # over max_body_size once decompressed
+        bomb = gzipped(json.dumps({"name": "joe", "pad": " " * 2000}))
+        self.assertLess(len(bomb), 1000)
+        self.assertEqual(self.fetch("/compressed", method="POST", body=bomb, headers={"Content-Encoding": "gzip"}).code, 413)
+        self.assertEqual(self.fetch("/compressed", method="POST", body="nope", headers={"Content-Encoding": "gzip"}).code, 400)
+
+    def test_streamed_compressed(self):
+        body = json.dumps({"name": "joe", "items": [{"id": n} for n in range(1000)]})
+        response = self.fetch("/streamed", method="POST", body=gzipped(body), headers={"Content-Encoding": "gzip"})
+        self.assertEqual(response.body, "Hello, joe 1000!")
+        body = json.dumps({"name": "joe", "items": [{"id": n} for n in range(100000)]})
+        response = self.fetch("/streamed", method="POST", body=gzipped(body), headers={"Content-Encoding": "gzip"})
+        self.assertEqual(response.code, 413)
+
+    def test_many(self):
+        records = [{"id": 1}, {"id": 0}, {"id": "3", "name": "c"}, "nope", {"name": "e"}, {"id": 6}]
+        for url in ("/batch", "/streamed/batch"):
+            response = self.fetch(url, method="POST", body=json.dumps(records))
+            self.assertEqual(response.code, 200)
+            body = json.loads(response.body)
+            self.assertEqual(body["ids"], [1, 3, 6])
+            self.assertEqual(sorted(body["errors"]), ["1", "3", "4"])
+            self.assertIn("at id", body["errors"]["1"])
+            self.assertEqual(self.fetch(url, method="POST", body='{"id": 1}').code, 400)
+            self.assertEqual(json.loads(self.fetch(url, method="POST", body='[]').body), {"ids": [], "errors": {}})
+
+    def test_profile(self):
+        profile.reset()
+        response = self.fetch("/profiled?id=1", method="POST", body='{"name": "joe", "user": {"email": "A@B.CO"}}')
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body)
+        # nullable defaults still apply
+        self.assertEqual(body["body"], {"name": "joe", "user": {"email": "a@b.co", "age": 0}})
+        self.assertEqual(sorted(body["log"]["validation"]), ["arguments.id", "body.name", "body.user", "body.user.email"])
+
+        self.assertEqual(self.fetch("/profiled", method="POST", body='{"name": "joe", "user": {"email": "no"}}').code, 400)
+        stats = profile.stats()
+        self.assertEqual(stats["fields"]["body.user.email"]["calls"], 2)
+        self.assertEqual(stats["validators"]["email"]["calls"], 2)
+        self.assertEqual(stats["fields"]["arguments.id"]["calls"], 1)
+        self.assertGreater(stats["fields"]["body.user"]["ms"], 0)
+
+        # streamed bodies are timed as they arrive, but for their streamed arrays
+        response = self.fetch("/streamed/profiled", method="POST", body='{"name": "joe", "items": [{"id": 1}]}')
+        self.assertEqual(sorted(json.loads(response.body)["log"]["validation"]), ["body.name"])
+
+        # each request's timings, however they are nested
+        first, second = {}, {}
+        with profile.timing(first):
+            with profile.timing(second):
+                profile.record("a", "string", 0.001)
+            profile.record("b", "string", 0.002)
+        profile.record("c", "string", 0.003)
+        self.assertEqual((sorted(first), sorted(second)), (["b"], ["a"]))
+
+    def test_cache(self):
+        cache = CachedHandler.get.arguments_cache
+        for url in ("/cached?name=joe&ids=1,2&joe=true", "/cached?joe=true&name=joe&ids=1,2&_=1417978116609",
+                    "/cached?ids=1,2&name=joe&joe=true"):
+            response = self.fetch(url)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body), {"name": "joe", "ids": [1, 2], "joe": True})
+        self.assertEqual((cache.misses, cache.hits), (1, 2))
+
+        self.assertEqual(self.fetch("/cached?name=andy").code, 400)
+        self.assertEqual(self.fetch("/cached?name=andy").code, 400)
+        self.assertEqual(len(cache), 1)
+
+        # file and relative date validators can not be cached
+        self.assertRaises(AssertionError, validated, {"since": "date"}, cache=10)
+        self.assertRaises(AssertionError, validated, {"f": valideer.Nullable("file")}, cache=10)
+
+        # validators have to be marked pure, their subclasses too
+        class lookup(valideer.String):
+            pass
+
+        class name(valideer.Validator):
+            pure = True
+
+        class nickname(name):
+            pass
+        self.assertRaises(AssertionError, validated, {"user": lookup()}, cache=10)
+        self.assertRaises(AssertionError, validated, {"user": nickname()}, cache=10)
+        validated({"user": name(), "ids": "ints", "name": valideer.Nullable("string")}, cache=10)
+        validated({"ref": "ref", "day": "day", "tz": "timezone"}, cache=10, compiled=True)
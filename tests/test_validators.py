@@ -1,10 +1,15 @@
+import os
+import tempfile
 import unittest
+from datetime import datetime
 import valideer
 import timestring
 from ddt import ddt, data
 from valideer import ValidationError as error
 
 from tornwrap.validators import *
+# the star import brings valideer's `validators` module and the `range` validator
+from tornwrap import validators
 
 
 @ddt
@@ -22,7 +27,7 @@ class Test(unittest.TestCase):
 
     @data(("y", True), ("yes", True), ("1", True), ("t", True), ("true", True), ("on", True), (True, True),
           ("n", False), ("no", False), ("0", False), ("f", False), ("false", False), ("off", False), (False, False),
-          ('idk', None), (range(10), None))
+          ('idk', None), (list(xrange(10)), None))
     def test_bool(self, (value, boolean)):
         if boolean is None:
             with self.assertRaises(valideer.ValidationError):
@@ -116,6 +121,25 @@ class Test(unittest.TestCase):
         for x in ('not', None, 'random', object(), int, ):
             self.assertRaises(error, schema.validate, dict(value=x))
 
+    def test_numbers(self):
+        schema = valideer.parse({"ids": "ints", "prices": "floats"})
+
+        result = schema.validate(dict(ids="1,2,-3", prices="1.5,2"))
+        self.assertEqual(result['ids'].typecode, 'l')
+        self.assertEqual(list(result['ids']), [1, 2, -3])
+        self.assertEqual(list(result['prices']), [1.5, 2.0])
+        # repeated arguments keep the int rules, thousands separators included
+        self.assertEqual(list(schema.validate(dict(ids=["1,000", "5k", "7"]))['ids']), [1000, 5000, 7])
+        self.assertEqual(list(schema.validate(dict(prices=["2.5k", 1]))['prices']), [2500.0, 1.0])
+
+        for x in ('1,,2', '1,a', '', '5%', ['5%'], '9' * 30, None, object()):
+            self.assertRaises(error, schema.validate, dict(ids=x))
+        self.assertRaises(error, integars(max_length=2).validate, "1,2,3")
+        self.assertRaises(error, integars(max_length=2).validate, [1, 2, 3])
+        # separators must group thousands
+        self.assertRaises(error, schema.validate, dict(prices=["1,2", "3"]))
+        self.assertRaises(error, valideer.parse("float").validate, "1,2")
+
     def test_ref(self):
         schema = valideer.parse({"value": "ref"})
 
@@ -125,6 +149,25 @@ class Test(unittest.TestCase):
         for x in (None, object(), int, -50):
             self.assertRaises(error, schema.validate, dict(value=x))
 
+    def test_union(self):
+        for schemas in (("branch", "commit"), ("commit", "uuid", "slug"), ("id", "uuid", "email"),
+                        (valideer.Enum(["a", "b"]), valideer.String(min_length=3), "commit"), ("int", "?handler")):
+            union, anyof = Union(*schemas), valideer.AnyOf(*schemas)
+            for value in (None, 1, 2.5, "a", "abc", "a" * 40, "123:abcdefabcdef", "foo/bar", "a@b.co",
+                          "0f0f0f0f-aaaa-bbbb-cccc-0123456789ab", "1k", u"uni", []):
+                try:
+                    expected = anyof.validate(value)
+                except error as e:
+                    with self.assertRaises(error) as raised:
+                        union.validate(value)
+                    self.assertEqual(raised.exception.msg, e.msg)
+                else:
+                    self.assertEqual(union.validate(value), expected)
+
+        # patterns are joined into one regex
+        self.assertIsNotNone(Union("commit", "uuid", "slug")._route(str)[0])
+        self.assertIsInstance(valideer.parse("ref"), Union)
+
     def test_email(self):
         schema = valideer.parse({"email": "email"})
         for email in ('def post(self, @example.com', 'hello@codecov.io', 'some123_!@a.b.cc.com'):
@@ -169,3 +212,78 @@ class Test(unittest.TestCase):
         for daterange in ('2 weeks', 'this year', 'next thursday'):
             self.assertEqual(schema.validate(dict(daterange=daterange))['daterange'], timestring.Range(daterange))
         self.assertRaises(error, schema.validate, dict(daterange="never"))
+
+    def test_timestring_cache(self):
+        cache = ParseCache(size=2)
+        first = cache.get(timestring.Range, "last 7 days")
+        second = cache.get(timestring.Range, "last 7 days")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.start, second.start)
+
+        # callers can not change the cached value
+        second.start.day = 1 if second.start.day > 1 else 2
+        self.assertEqual(cache.get(timestring.Range, "last 7 days"), first)
+
+        cache.get(timestring.Date, "today")
+        cache.get(timestring.Date, "today", tz="UTC")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.misses, 3)
+        self.assertRaises(timestring.TimestringInvalid, cache.get, timestring.Date, "never")
+        self.assertEqual(len(cache), 2)
+
+        # relative values are parsed again in the next time bucket
+        cache = ParseCache(resolution=0.000001)
+        cache.get(timestring.Date, "now")
+        cache.get(timestring.Date, "now")
+        self.assertEqual(cache.misses, 2)
+
+    def test_iso_dates(self):
+        for value in ('2015-01-15', '2015-01-15T10:30:00', '2015-01-15 10:30', '2015-01-15T10:30:00Z', '1421318400', 1421318400):
+            self.assertEqual(parse_date(value).date, timestring.Date(value).date)
+            self.assertEqual(parse_date(value, tz="UTC").date, timestring.Date(value, tz="UTC").date)
+        self.assertEqual(parse_date(1421318400.5).date.microsecond, 500000)
+        self.assertRaises(timestring.TimestringInvalid, parse_date, '2015-02-30')
+
+        _range = parse_range('2015-01-15')
+        self.assertEqual((_range.start.date, _range.end.date), (datetime(2015, 1, 15), datetime(2015, 1, 16)))
+        _range = parse_range('2015-01-15,2015-01-20T12:00:00', tz="UTC")
+        self.assertEqual((_range.start.date.day, _range.end.date.day, _range.end.date.hour), (15, 20, 12))
+        self.assertEqual(str(_range.start.tz), "UTC")
+        self.assertEqual(parse_range('2015-01-15T10:30:00'), timestring.Range('2015-01-15T10:30:00'))
+        self.assertEqual(parse_range('last 7 days'), timestring.Range('last 7 days'))
+
+        schema = valideer.parse({"range": "daterangetz"})
+        self.assertEqual(schema.validate(dict(range='2015-01-15,2015-01-20'))['range'].end.date.day, 20)
+        self.assertRaises(error, schema.validate, dict(range='2015-01-15,2015-13-20'))
+
+    def test_timezone_index(self):
+        schema = valideer.parse({"value": "timezone"})
+        for key, value in (('europe/paris', 'Europe/Paris'), ('America/New_York', 'America/New_York'),
+                           ('JST', 'Asia/Tokyo'), ('aest', 'Australia/Sydney'), ('CET', 'CET'),
+                           ('+05:30', 'Asia/Kolkata'), ('0530', 'Asia/Kolkata'), ('UTC+9', 'Etc/GMT-9'),
+                           ('GMT-3', 'Etc/GMT+3'), ('-4', 'US/Eastern'), ('EST', 'US/Eastern')):
+            self.assertEqual(schema.validate(dict(value=key))['value'], value)
+        # ambiguous or out of range
+        for key in ('IST', '+15', 'europe/nowhere'):
+            self.assertRaises(error, schema.validate, dict(value=key))
+
+        # built once, then loaded by other processes
+        path = os.path.join(tempfile.mkdtemp(), "timezones.json")
+        index = TimezoneIndex(path)
+        self.assertEqual(index.get("asia/tokyo"), "Asia/Tokyo")
+        self.assertTrue(os.path.exists(path))
+        index = TimezoneIndex(path)
+        index.build = None
+        self.assertEqual(index.get("asia/tokyo"), "Asia/Tokyo")
+
+        # files writable by others or naming unknown zones are built again
+        for mode, planted in ((0o666, {"ASIA/TOKYO": "Asia/Tokyo"}), (0o644, {"ASIA/TOKYO": "Evil/Zone"})):
+            os.remove(path)
+            with open(path, "w") as f:
+                json.dump(planted, f)
+            os.chmod(path, mode)
+            index = TimezoneIndex(path)
+            self.assertEqual(index.get("europe/paris"), "Europe/Paris")
+            self.assertEqual(index.get("asia/tokyo"), "Asia/Tokyo")
@@ -3,6 +3,7 @@ from stripe import Stripe
 from .validated import validated
 from .handler import RequestHandler
 from .ratelimited import ratelimited
+from .ratelimited import concurrency_limited
 
 from . import logger
 
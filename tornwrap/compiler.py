@@ -0,0 +1,178 @@
+from valideer import Enum
+from valideer import parse
+from valideer import Type
+from valideer import Object
+from valideer import String
+from valideer import Pattern
+from valideer import Nullable
+from valideer import Validator
+from valideer import ValidationError
+
+from . import validators
+
+
+def _function(cls):
+    return getattr(cls.validate, "im_func", cls.validate)
+
+
+def _type(validator, n, namespace):
+    namespace["accept_%d" % n] = validator.accept_types
+    namespace["reject_%d" % n] = validator.reject_types
+    return "isinstance(v, accept_%d) and not isinstance(v, reject_%d)" % (n, n), "v"
+
+
+def _string(validator, n, namespace):
+    if validator._min_length is not None or validator._max_length is not None:
+        return None
+    return _type(validator, n, namespace)
+
+
+def _pattern(validator, n, namespace):
+    namespace["match_%d" % n] = validator.regexp.match
+    return "%s and match_%d(v)" % (_type(validator, n, namespace)[0], n), "v"
+
+
+def _enum(validator, n, namespace):
+    if not isinstance(validator.values, set):
+        return None
+    namespace["values_%d" % n] = validator.values
+    return "isinstance(v, basestring) and v in values_%d" % n, "v"
+
+
+def _boolean(validator, n, namespace):
+    namespace["booleans_%d" % n] = dict([(x, True) for x in validator.true] + [(x, False) for x in validator.false])
+    return ("type(v) is bool or (type(v) is str and v.lower() in booleans_%d)" % n,
+            "v if type(v) is bool else booleans_%d[v.lower()]" % n)
+
+
+def _id(validator, n, namespace):
+    namespace["match_%d" % n] = validator.regexp.match
+    return "(type(v) is int and v > 0) or (type(v) is str and match_%d(v))" % n, "int(v)"
+
+
+def _email(validator, n, namespace):
+    namespace["match_%d" % n] = validator.regexp.match
+    return "isinstance(v, basestring) and match_%d(v)" % n, "v.lower()"
+
+
+def _integar(validator, n, namespace):
+    # plain digits only, short enough that int(float(v)) == int(v)
+    return "type(v) is int or (type(v) is str and len(v) < 16 and v.isdigit())", "int(v)"
+
+
+def _float(validator, n, namespace):
+    return "type(v) in (float, int, long)", "float(v)"
+
+
+# validate function: returns (condition, adapted) source, both reading `v`
+# a failed condition falls back to the validator, which raises the usual error
+INLINE = {
+    _function(Type): _type,
+    _function(String): _string,
+    _function(Pattern): _pattern,
+    _function(Enum): _enum,
+    _function(validators.boolean): _boolean,
+    _function(validators._id): _id,
+    _function(validators.email): _email,
+    _function(validators.integar): _integar,
+    _function(validators._float): _float,
+}
+
+
+class CompiledObject(Validator):
+    """An `Object` validator flattened into one generated function
+
+    Required keys are checked inline and common validators (types, patterns,
+    enums and tornwrap's bool, id, email, int and float) are inlined with
+    their regexes pre-bound. Anything the inline checks do not accept is
+    passed to the original validator, so results and errors are unchanged.
+    """
+    pure = True
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.source, self.validate = compile_object(schema)
+
+    @property
+    def humanized_name(self):
+        return self.schema.humanized_name
+
+
+def compile_schema(schema):
+    """Returns a CompiledObject for a parsed (or parsable) object schema,
+    other schemas are returned parsed but unchanged
+    """
+    if isinstance(schema, CompiledObject):
+        return schema
+    if not isinstance(schema, Validator):
+        schema = parse(schema)
+    if type(schema) is Object:
+        return CompiledObject(schema)
+    return schema
+
+
+def compile_object(schema):
+    namespace = dict(ValidationError=ValidationError, Mapping=schema.accept_types,
+                     validate_object=schema.validate, UNDEFINED=Nullable._UNDEFINED)
+    required = sorted(schema._required_keys)
+    ignore_errors = getattr(schema, "_ignore_optional_errors", False)
+
+    lines = ["def validate(value, adapt=True):",
+             "    if not adapt or not isinstance(value, Mapping):",
+             "        return validate_object(value, adapt)"]
+    if required:
+        lines += ["    if not (%s):" % " and ".join("%r in value" % key for key in required),
+                  "        return validate_object(value, adapt)"]
+    lines.append("    result = dict(value)")
+
+    for n, (key, validator) in enumerate(schema._named_validators):
+        # a validate set on the instance (ex. profiled) is called as is
+        wrapped = "validate" in vars(validator)
+        validator = compile_schema(validator) if type(validator) is Object and not wrapped else validator
+        namespace["validate_%d" % n] = validator.validate
+        inline = None if wrapped else INLINE.get(_function(type(validator)))
+        inline = inline(validator, n, namespace) if inline else None
+        if ignore_errors and key not in required:
+            on_error = "del result[%r]" % key
+        else:
+            on_error = "raise ex.add_context(%r)" % key
+
+        lines += ["    if %r in value:" % key,
+                  "        v = value[%r]" % key]
+        indent = "        "
+        if inline:
+            lines += ["        if %s:" % inline[0],
+                      "            result[%r] = %s" % (key, inline[1]),
+                      "        else:"]
+            indent += "    "
+        lines += [indent + "try:",
+                  indent + "    result[%r] = validate_%d(v, True)" % (key, n),
+                  indent + "except ValidationError as ex:",
+                  indent + "    " + on_error]
+        if isinstance(validator, Nullable):
+            namespace["nullable_%d" % n] = validator
+            lines += ["    else:",
+                      "        default = nullable_%d.default_object_property" % n,
+                      "        if default is not UNDEFINED:",
+                      "            result[%r] = default" % key]
+
+    additional = schema._additional
+    if additional is not True:
+        namespace["keys"] = frozenset(schema._all_keys)
+        lines.append("    for key in value:")
+        lines.append("        if key not in keys:")
+        if additional is False:
+            lines.append("            return validate_object(value, adapt)")
+        elif additional is Object.REMOVE:
+            lines.append("            del result[key]")
+        else:
+            namespace["validate_additional"] = additional.validate
+            lines += ["            try:",
+                      "                result[key] = validate_additional(value[key], True)",
+                      "            except ValidationError as ex:",
+                      "                raise ex.add_context(key)"]
+
+    lines.append("    return result")
+    source = "\n".join(lines) + "\n"
+    exec compile(source, "<compiled schema>", "exec") in namespace
+    return source, namespace["validate"]
@@ -14,6 +14,7 @@ except ImportError:
     rollbar = None
 
 from . import logger
+from .helpers import query_arguments
 
 
 CONTENT_TYPES = {
@@ -55,12 +56,7 @@ class RequestHandler(web.RequestHandler):
 
     @property
     def query(self):
-        if not hasattr(self, "_query"):
-            query = dict([(k, v[0] if len(v) == 1 else v) for k, v in self.request.query_arguments.items() if v != ['']]) if self.request.query_arguments else {}
-            query.pop('access_token', False)
-            query.pop('_', None)  # ?_=1417978116609
-            self._query = query
-        return self._query
+        return query_arguments(self.request)
 
     def was_rate_limited(self, tokens, remaining, ttl):
         raise HTTPError(403, reason="You have been rate limited.")
@@ -1,5 +1,7 @@
 import re
 from json import dumps
+from threading import Lock
+from collections import OrderedDict
 from tornado import escape
 from decimal import Decimal
 from datetime import datetime
@@ -74,3 +76,72 @@ def json_minify(string, strip_space=True):  # pragma: no cover
 
     new_str.append(string[index:])
     return ''.join(new_str)
+
+
+class QueryArguments(dict):
+    """Url arguments of a request, single values unwrapped (?a=1&b=2&b=3 is
+    {"a": "1", "b": ["2", "3"]}) without empty values, `access_token` or
+    keys starting with `_` (ex. ?_=1417978116609)
+
+    `raw` is the request's own `query_arguments`, not copied nor filtered.
+    """
+    def __init__(self, raw):
+        dict.__init__(self, [(k, v[0] if len(v) == 1 else v) for k, v in raw.iteritems()
+                             if v != [''] and not k.startswith('_') and k != 'access_token'])
+        self.raw = raw
+
+
+def query_arguments(request):
+    """Returns the `QueryArguments` of the request, built once and shared
+    by `RequestHandler.query` and `@validated`
+    """
+    try:
+        return request._query_arguments
+    except AttributeError:
+        request._query_arguments = QueryArguments(request.query_arguments)
+        return request._query_arguments
+
+
+class LRUCache(object):
+    """Thread safe LRU of `function(*args)` keyed by `key(*args)`
+
+    A key of None is not cached, exceptions (ex. invalid values) are not
+    cached either. Results are returned through `copy` so callers can not
+    change the cache.
+    """
+    def __init__(self, function, key, copy=None, size=1024):
+        self.function = function
+        self.key = key
+        self.copy = copy or (lambda value: value)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.hits = self.misses = 0
+
+    def get(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        if key is None:
+            return self.function(*args, **kwargs)
+        with self._lock:
+            result = self._values.pop(key, None)
+            if result is not None:
+                self._values[key] = result
+                self.hits += 1
+                return self.copy(result)
+            self.misses += 1
+
+        result = self.function(*args, **kwargs)
+        with self._lock:
+            self._values[key] = result
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+        return self.copy(result)
@@ -44,6 +44,7 @@ def handler(handler):
 
     data.update(handler.get_log_payload() or {})
     data.update(getattr(handler, '_log_error', {}))
+    data.update(getattr(handler, '_log_validation', {}))
     data = dumps(
         data,
         default=json_defaults,
@@ -1,7 +1,588 @@
+import mmap
+import socket
+import struct
 import functools
+from time import time
+from uuid import uuid4
+from hashlib import md5
+from multiprocessing import Lock
+from datetime import timedelta
+from math import ceil
+from collections import deque
+from collections import OrderedDict
+from hashlib import sha1
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.concurrent import is_future
 
+from .logger import traceback
 
-def ratelimited(user=None, guest=None, redis_key_format="ratelimited.%s"):
+
+# check, decrement and read the ttl in one atomic round trip
+# KEYS[1] redis key, ARGV[1] tokens, ARGV[2] refresh
+FIXED_WINDOW = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SETEX', KEYS[1], ARGV[2], ARGV[1] - 1)
+    return {ARGV[1] - 1, tonumber(ARGV[2])}
+end
+local remaining = redis.call('DECR', KEYS[1])
+local ttl = redis.call('TTL', KEYS[1])
+if ttl < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+return {remaining, ttl}
+"""
+FIXED_WINDOW_SHA = sha1(FIXED_WINDOW).hexdigest()
+
+# take up to ARGV[3] tokens at once, returns {granted, remaining, ttl}
+LEASE = """
+local remaining = tonumber(redis.call('GET', KEYS[1]))
+local ttl
+if remaining == nil then
+    remaining = tonumber(ARGV[1])
+    ttl = tonumber(ARGV[2])
+    redis.call('SETEX', KEYS[1], ttl, remaining)
+else
+    ttl = redis.call('TTL', KEYS[1])
+    if ttl < 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        ttl = tonumber(ARGV[2])
+    end
+end
+local granted = math.min(tonumber(ARGV[3]), math.max(remaining, 0))
+if granted > 0 then
+    remaining = redis.call('DECRBY', KEYS[1], granted)
+end
+return {granted, remaining, ttl}
+"""
+LEASE_SHA = sha1(LEASE).hexdigest()
+
+# generic cell rate algorithm, one key holding the theoretical arrival time
+# ARGV[3] now in ms, tokens are spaced refresh / tokens apart with a burst of tokens
+GCRA = """
+local interval = ARGV[2] * 1000 / ARGV[1]
+local burst = ARGV[2] * 1000
+local now = tonumber(ARGV[3])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local allow_at = tat + interval - burst
+if allow_at > now then
+    return {-1, math.ceil((allow_at - now) / 1000)}
+end
+tat = math.ceil(tat + interval)
+redis.call('SET', KEYS[1], tat, 'PX', tat - now)
+return {math.floor((now - allow_at) / interval), math.ceil((tat - now) / 1000)}
+"""
+GCRA_SHA = sha1(GCRA).hexdigest()
+
+# sliding counter, the previous window (KEYS[2]) weighted by how much of it still overlaps
+# ARGV[3] ms elapsed in the current window (KEYS[1]), rejected requests are not counted
+SLIDING = """
+local tokens = tonumber(ARGV[1])
+local window = ARGV[2] * 1000
+local elapsed = tonumber(ARGV[3])
+local previous = tonumber(redis.call('GET', KEYS[2]) or 0)
+local used = math.floor(previous * (window - elapsed) / window) + tonumber(redis.call('GET', KEYS[1]) or 0)
+local ttl = math.ceil((window - elapsed) / 1000)
+if used >= tokens then
+    return {-1, ttl}
+end
+if redis.call('INCR', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2] * 2)
+end
+return {tokens - used - 1, ttl}
+"""
+SLIDING_SHA = sha1(SLIDING).hexdigest()
+
+# in-flight leases, a sorted set of lease ids scored by when they expire
+# ARGV[1] limit, ARGV[2] expire (s), ARGV[3] now, ARGV[4] lease id
+CONCURRENCY = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local count = redis.call('ZCARD', KEYS[1])
+if count >= tonumber(ARGV[1]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return {-1, math.ceil(oldest[2] - ARGV[3])}
+end
+redis.call('ZADD', KEYS[1], ARGV[3] + ARGV[2], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {ARGV[1] - count - 1, tonumber(ARGV[2])}
+"""
+CONCURRENCY_SHA = sha1(CONCURRENCY).hexdigest()
+
+
+def fixed(key, tokens, refresh):
+    """Fixed window counter, allows up to 2x tokens around a window boundary"""
+    return FIXED_WINDOW, FIXED_WINDOW_SHA, [key], [tokens, refresh]
+
+
+def gcra(key, tokens, refresh):
+    """Evenly spaced tokens with a burst of `tokens`, one key and no TTL read"""
+    # a timestamp, kept apart from the counters of the other algorithms
+    return GCRA, GCRA_SHA, ["%s.gcra" % key], [tokens, refresh, int(time() * 1000)]
+
+
+def sliding(key, tokens, refresh):
+    """Approximated sliding window over the current and previous fixed windows"""
+    now = int(time() * 1000)
+    window, elapsed = divmod(now, refresh * 1000)
+    return SLIDING, SLIDING_SHA, ["%s.sliding.%d" % (key, window), "%s.sliding.%d" % (key, window - 1)], [tokens, refresh, elapsed]
+
+
+ALGORITHMS = dict(fixed=fixed, gcra=gcra, sliding=sliding)
+
+
+def is_noscript(error):
+    """redis-py raises NoScriptError, other clients pass the raw reply through
+    """
+    return type(error).__name__ == 'NoScriptError' or str(error).startswith('NOSCRIPT')
+
+
+def evalsha(redis, script, sha, keys, args):
+    """Run a cached script, sending the full source when redis lost it (restart, SCRIPT FLUSH)
+    EVAL caches the script again so the next call is back to EVALSHA
+    """
+    try:
+        result = redis.evalsha(sha, len(keys), *(keys + args))
+    except Exception as e:
+        if not is_noscript(e):
+            raise
+        return redis.eval(script, len(keys), *(keys + args))
+    if is_future(result):
+        # async clients report NOSCRIPT when the future resolves
+        return _reload_on_noscript(result, redis, script, keys, args)
+    return result
+
+
+@gen.coroutine
+def _reload_on_noscript(future, redis, script, keys, args):
+    try:
+        result = yield future
+    except Exception as e:
+        if not is_noscript(e):
+            raise
+        result = yield redis.eval(script, len(keys), *(keys + args))
+    raise gen.Return(result)
+
+
+class PipelineBatch(object):
+    """Scripts queued within one IOLoop tick (or `window` seconds) sent as one pipeline
+
+    Each call gets a future resolved from its own reply in the batch.
+    """
+    def __init__(self, window=0):
+        self.window = window
+        # redis client: [(script, sha, keys, args, future)]
+        self.pending = {}
+
+    def evalsha(self, redis, script, sha, keys, args):
+        future = Future()
+        if redis not in self.pending:
+            self.pending[redis] = []
+            if self.window:
+                IOLoop.current().call_later(self.window, self.flush, redis)
+            else:
+                IOLoop.current().add_callback(self.flush, redis)
+        self.pending[redis].append((script, sha, keys, args, future))
+        return future
+
+    @gen.coroutine
+    def flush(self, redis):
+        pending = self.pending.pop(redis)
+        pipe = redis.pipeline(transaction=False)
+        for script, sha, keys, args, future in pending:
+            pipe.evalsha(sha, len(keys), *(keys + args))
+
+        try:
+            results = pipe.execute(raise_on_error=False)
+            if is_future(results):
+                results = yield results
+        except Exception as e:
+            for call in pending:
+                call[4].set_exception(e)
+            return
+
+        for (script, sha, keys, args, future), result in zip(pending, results):
+            try:
+                if isinstance(result, Exception):
+                    if not is_noscript(result):
+                        raise result
+                    # the first EVAL loads the script again for the rest
+                    result = evalsha(redis, script, sha, keys, args)
+                    if is_future(result):
+                        result = yield result
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+
+
+class LeaseTable(object):
+    """Blocks of tokens leased from redis and spent from memory
+
+    Tokens are taken from redis before they are served, so across workers
+    at most `size` extra requests per worker are admitted when a lease
+    outlives the window it was taken from. Past `max_keys` expired leases
+    are dropped, then the oldest ones (their unspent tokens are lost).
+    """
+    max_keys = 10000
+
+    def __init__(self, size):
+        assert type(size) is int and size > 0, "lease must be int and > 0"
+        self.size = size
+        # key: [tokens left in the lease, tokens left in redis, window reset at], oldest first
+        self.leases = OrderedDict()
+
+    def take(self, key):
+        """Returns (remaining, ttl) when the request can be answered from memory
+        """
+        lease = self.leases.get(key)
+        if lease:
+            now = time()
+            if lease[2] <= now:
+                del self.leases[key]
+            elif lease[0] > 0:
+                lease[0] -= 1
+                return lease[0] + lease[1], int(ceil(lease[2] - now))
+            elif lease[1] <= 0:
+                # window spent everywhere, no need to ask redis again
+                return -1, int(ceil(lease[2] - now))
+
+    def acquire(self, redis, key, tokens, refresh):
+        result = evalsha(redis, LEASE, LEASE_SHA, [key], [tokens, refresh, self.size])
+        if is_future(result):
+            return self._store_async(key, result)
+        return self.store(key, *result)
+
+    def store(self, key, granted, remaining, ttl):
+        granted, remaining, ttl = int(granted), int(remaining), int(ttl)
+        now = time()
+        lease = self.leases.get(key)
+        if lease is None or lease[2] <= now:
+            self.leases.pop(key, None)
+            if len(self.leases) >= self.max_keys:
+                for _key in [k for k, v in self.leases.iteritems() if v[2] <= now]:
+                    del self.leases[_key]
+                while len(self.leases) >= self.max_keys:
+                    self.leases.popitem(last=False)
+            lease = self.leases[key] = [0, remaining, now + ttl]
+        # async clients may have several leases in flight for one key, add them up
+        lease[0] += granted
+        lease[1], lease[2] = remaining, now + ttl
+        if lease[0] > 0:
+            lease[0] -= 1
+            return lease[0] + lease[1], ttl
+        return -1, ttl
+
+    @gen.coroutine
+    def _store_async(self, key, future):
+        result = yield future
+        raise gen.Return(self.store(key, *result))
+
+
+class CircuitBreaker(object):
+    """Skips the limiter's redis calls while redis is failing or slow
+
+    After `failures` consecutive errors or replies slower than `timeout` ms
+    the breaker opens and requests are let through (`fail_open=True`) or
+    rate limited (`fail_open=False`) without asking redis for `cooldown`
+    seconds. One trial call is then made, closing the breaker on success.
+
+    Async clients are abandoned once `timeout` passes, blocking clients can
+    not be interrupted (set `socket_timeout` on them) so a slow reply only
+    counts as a failure.
+    """
+    def __init__(self, timeout=None, failures=5, cooldown=30, fail_open=True):
+        assert timeout is None or timeout > 0, "timeout must be ms > 0"
+        assert type(failures) is int and failures > 0, "failures must be int and > 0"
+        assert cooldown > 0, "cooldown must be seconds > 0"
+        self.timeout = timeout / 1000.0 if timeout else None
+        self.failures = failures
+        self.cooldown = cooldown
+        self.fail_open = fail_open
+        self.failed = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time() >= self.opened_at + self.cooldown else "open"
+
+    @property
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(int(ceil(self.opened_at + self.cooldown - time())), 0)
+
+    def call(self, fn, *args):
+        """Returns the result of `fn`, or None when it was skipped or failed
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial):
+            return None
+        self.trial = state == "half-open"
+
+        started = time()
+        try:
+            result = fn(*args)
+        except Exception:
+            traceback()
+            self.failure()
+            return None
+
+        if is_future(result):
+            return self._call_async(result, started)
+        return self.success(started, result)
+
+    @gen.coroutine
+    def _call_async(self, future, started):
+        try:
+            if self.timeout:
+                result = yield gen.with_timeout(timedelta(seconds=self.timeout), future)
+            else:
+                result = yield future
+        except gen.TimeoutError:
+            self.failure()
+            raise gen.Return(None)
+        except Exception:
+            traceback()
+            self.failure()
+            raise gen.Return(None)
+        raise gen.Return(self.success(started, result))
+
+    def success(self, started, result):
+        if self.timeout and time() - started > self.timeout:
+            # answered, but over budget
+            self.failure()
+        else:
+            self.failed, self.opened_at, self.trial = 0, None, False
+        return result
+
+    def failure(self):
+        self.failed += 1
+        self.trial = False
+        if self.failed >= self.failures or self.opened_at is not None:
+            self.opened_at = time()
+
+
+class RedisBackend(object):
+    """Checks against a given redis client instead of `handler.redis`
+    """
+    def __init__(self, client, algorithm="fixed"):
+        assert algorithm in ALGORITHMS, "algorithm must be one of %s" % ", ".join(sorted(ALGORITHMS))
+        self.client = client
+        self.algorithm = ALGORITHMS[algorithm]
+
+    def check(self, key, tokens, refresh):
+        return evalsha(self.client, *self.algorithm(key, tokens, refresh))
+
+
+class SharedMemoryBackend(object):
+    """Fixed window counters in an anonymous shared mmap, for per-host limits
+
+    Create it before forking (ex. at import time, as the decorator does) so
+    every worker forked from the parent shares the same table. Keys hash to
+    a bucket of `ways` slots guarded by one of `locks` process locks, a full
+    bucket evicts expired windows first, then the least recently seen key.
+    """
+    slot = struct.Struct("<Qddq")  # key hash, window ends at, last seen, remaining
+
+    def __init__(self, slots=65536, ways=8, locks=64):
+        assert slots >= ways > 0 and slots % ways == 0, "slots must be a multiple of ways"
+        self.ways = ways
+        self.buckets = slots // ways
+        self.memory = mmap.mmap(-1, slots * self.slot.size)
+        self.locks = [Lock() for x in xrange(min(locks, self.buckets))]
+
+    def check(self, key, tokens, refresh):
+        keyhash = struct.unpack("<Q", md5(key).digest()[:8])[0] or 1
+        bucket = keyhash % self.buckets
+        offset = bucket * self.ways * self.slot.size
+        with self.locks[bucket % len(self.locks)]:
+            now = time()
+            victim, oldest = None, None
+            for x in xrange(self.ways):
+                position = offset + x * self.slot.size
+                _keyhash, ends, seen, remaining = self.slot.unpack_from(self.memory, position)
+                if _keyhash == keyhash:
+                    if ends > now:
+                        self.slot.pack_into(self.memory, position, keyhash, ends, now, remaining - 1)
+                        return remaining - 1, int(ceil(ends - now))
+                    victim = position
+                    break
+                # empty and expired slots go first
+                seen = 0 if ends <= now else seen
+                if victim is None or seen < oldest:
+                    victim, oldest = position, seen
+
+            self.slot.pack_into(self.memory, victim, keyhash, now + refresh, now, tokens - 1)
+            return tokens - 1, refresh
+
+
+EXEMPT, DENY = "exempt", "deny"
+
+
+def limits(name, value):
+    """Validate a (tokens, refresh) tuple, None means not limited
+    """
+    if value:
+        assert type(value[0]) is int and value[0] > 0, "%s[0] must be int and > 0" % name
+        assert type(value[1]) is int and value[1] > 0, "%s[1] must be int and > 0" % name
+        return tuple(value)
+    return (None, None)
+
+
+def ip_to_int(ip):
+    """Returns (version, int) for an ipv4 or ipv6 address, ipv4 mapped ipv6 is treated as ipv4
+    """
+    if ip[:7] == "::ffff:" and "." in ip:
+        ip = ip[7:]
+    if ":" in ip:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip))
+        return 6, (high << 64) | low
+    return 4, struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+
+
+class NetworkPolicy(object):
+    """Longest prefix match of `remote_ip` over a table of networks
+
+        NetworkPolicy({"10.0.0.0/8": "exempt",
+                       "203.0.113.0/24": dict(user=(10000, 3600), guest=(5000, 3600)),
+                       "198.51.100.0/24": (100, 3600),
+                       "192.0.2.66/32": "deny"})
+
+    `exempt` networks skip the limiter (and redis) entirely, `deny` networks
+    are always rate limited, a tuple applies to users and guests alike.
+    Each distinct prefix length holds one dict keyed by the masked network,
+    so a lookup is at most one dict hit per prefix length in the table and
+    each network costs a single dict entry.
+    """
+    def __init__(self, table):
+        # version: [(prefix length, {network >> host bits: policy})] longest first
+        self.tables = {4: {}, 6: {}}
+        self._lengths = None
+        for network, policy in (table.items() if isinstance(table, dict) else table):
+            self.add(network, policy)
+
+    def add(self, network, policy):
+        if policy not in (EXEMPT, DENY):
+            if isinstance(policy, dict):
+                policy = (limits("user", policy.get("user")), limits("guest", policy.get("guest")))
+            else:
+                policy = (limits("user", policy), limits("guest", policy))
+        address, _, length = network.partition("/")
+        version, address = ip_to_int(address)
+        bits = 32 if version == 4 else 128
+        length = int(length) if length else bits
+        assert 0 <= length <= bits, "invalid prefix length in %s" % network
+        self.tables[version].setdefault(length, {})[address >> (bits - length)] = policy
+        self._lengths = None
+
+    def lookup(self, ip):
+        """Returns `exempt`, `deny`, a (user, guest) limits pair or None
+        """
+        if self._lengths is None:
+            self._lengths = dict((version, [(length, table, (32 if version == 4 else 128) - length)
+                                            for length, table in sorted(tables.items(), reverse=True)])
+                                 for version, tables in self.tables.items())
+        try:
+            version, address = ip_to_int(ip)
+        except (socket.error, ValueError):
+            return None
+        for length, table, shift in self._lengths[version]:
+            policy = table.get(address >> shift)
+            if policy is not None:
+                return policy
+
+
+class LoadMonitor(object):
+    """Shrinks token budgets while the IOLoop lags or handlers slow down
+
+    Every `interval` seconds the lag of a timer on the IOLoop and the p95 of
+    recent handler times are compared to `max_lag` and `max_latency` (ms).
+    Past either, guest budgets shrink in proportion to the load and user
+    budgets only once it is twice over, never below `floor` of the tokens.
+    Budgets recover the same way as the load drops.
+    """
+    def __init__(self, max_lag=50, max_latency=500, interval=0.5, floor=0.1, samples=256):
+        assert max_lag > 0 and max_latency > 0, "max_lag and max_latency must be ms > 0"
+        assert 0 < floor <= 1, "floor must be > 0 and <= 1"
+        self.max_lag = max_lag / 1000.0
+        self.max_latency = max_latency / 1000.0
+        self.interval = interval
+        self.floor = floor
+        self.latencies = deque(maxlen=samples)
+        self.lag, self.p95 = 0.0, 0.0
+        self.guest, self.user = 1.0, 1.0
+        self.started = False
+
+    def scale(self, tokens, user):
+        """Returns the tokens to allow right now
+        """
+        if not self.started:
+            self.started = True
+            self._schedule()
+        return max(int(tokens * (self.user if user else self.guest)), 1)
+
+    def observe(self, seconds):
+        self.latencies.append(seconds)
+
+    def update(self):
+        latencies = sorted(self.latencies)
+        self.p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        load = max(self.lag / self.max_lag, self.p95 / self.max_latency)
+        self.guest = 1.0 if load <= 1 else max(1.0 / load, self.floor)
+        self.user = 1.0 if load <= 2 else max(2.0 / load, self.floor)
+
+    def _schedule(self):
+        ioloop = IOLoop.current()
+        deadline = ioloop.time() + self.interval
+        ioloop.call_at(deadline, self._tick, deadline)
+
+    def _tick(self, deadline):
+        # smoothed so one slow callback does not halve every budget
+        self.lag = (self.lag + max(IOLoop.current().time() - deadline, 0)) / 2
+        self.update()
+        self._schedule()
+
+
+def proceed(handler, tokens, result, breaker, shed=0):
+    """Returns True when the request may continue, `result` is None when the breaker skipped redis
+    `shed` tokens are taken off the budget by the LoadMonitor
+    """
+    if result is None:
+        return breaker.fail_open or allowed(handler, tokens - shed, -1, breaker.retry_after)
+    return allowed(handler, tokens - shed, int(result[0] or 0) - shed, result[1])
+
+
+def allowed(handler, tokens, remaining, ttl):
+    """Set the rate limit headers, returns True when the request may continue
+    """
+    remaining, ttl = int(remaining or 0), int(ttl or 0)
+
+    handler.set_header("X-RateLimit-Limit", tokens)
+    handler.set_header("X-RateLimit-Remaining", (0 if remaining < 0 else remaining))
+    handler.set_header("X-RateLimit-Reset", ttl)
+
+    if remaining < 0:
+        return handler.was_rate_limited(tokens, 0, ttl) is True
+    return True
+
+
+@gen.coroutine
+def _limit_async(handler, future, tokens, shed, breaker, method, args, kwargs):
+    result = yield future
+    if not proceed(handler, tokens, result, breaker, shed):
+        return
+
+    result = method(handler, *args, **kwargs)
+    if is_future(result):
+        result = yield result
+    raise gen.Return(result)
+
+
+def ratelimited(user=None, guest=None, redis_key_format="ratelimited.%s", lease=None, batch=None, algorithm="fixed", breaker=None, backend=None, networks=None, adaptive=None):
     """Rate limit decorator
 
     ### Headers
@@ -12,25 +593,86 @@ def ratelimited(user=None, guest=None, redis_key_format="ratelimited.%s"):
     ### Status when rate limited
     Status: 403 Forbidden
 
+    ### Algorithms
+    `algorithm="fixed"` (default) counts per window, `"gcra"` spaces requests
+    evenly allowing a burst of `tokens` and `"sliding"` weights the previous
+    window so no 2x burst is allowed around window boundaries.
+
+    ### Async redis
+    When `self.redis` returns futures (same call signatures as redis-py)
+    the check is awaited and the handler method becomes a coroutine,
+    a blocking client keeps the synchronous path.
+
+    ### Leasing
+    `lease=50` takes 50 tokens from redis at a time and spends them
+    in process, only going back to redis when they run out or expire.
+
+    ### Batching
+    `batch=True` sends every check queued within one IOLoop tick as one
+    redis pipeline, `batch=500` waits up to 500 microseconds to collect them.
+
+    ### Circuit breaker
+    `breaker=CircuitBreaker(timeout=5)` gives each check a 5 ms budget and
+    stops calling redis for a cooldown after repeated errors or slow replies.
+    Pass the same breaker to every decorator using the same redis.
+
+    ### Backends
+    `backend=SharedMemoryBackend()` keeps the counters in memory shared by
+    forked workers, `RedisBackend(client)` uses a given client. Any object
+    with `check(key, tokens, refresh)` returning `(remaining, ttl)` or a
+    future of it can be used, `self.redis` is then not required.
+    Backends count fixed windows, other algorithms need the default.
+
+    ### Networks
+    `networks=NetworkPolicy({...})` exempts, denies or applies other limits
+    to clients by the longest matching network of their ip.
+
+    ### Adaptive
+    `adaptive=LoadMonitor(max_lag=50, max_latency=500)` shrinks the budgets,
+    guests first, while the worker is overloaded. Handler times are measured
+    around the decorated method (including its future).
+
     """
-    if user:
-        assert type(user[0]) is int and user[0] > 0, "user[0] must be int and > 0"
-        assert type(user[1]) is int and user[1] > 0, "user[1] must be int and > 0"
-    else:
-        user = (None, None)
-
-    if guest:
-        assert type(guest[0]) is int and guest[0] > 0, "guest[0] must be int and > 0"
-        assert type(guest[1]) is int and guest[1] > 0, "guest[1] must be int and > 0"
-    else:
-        guest = (None, None)
+    user, guest = limits("user", user), limits("guest", guest)
+
+    assert algorithm in ALGORITHMS, "algorithm must be one of %s" % ", ".join(sorted(ALGORITHMS))
+    assert not (lease and batch), "lease and batch can not be combined"
+    assert not lease or algorithm == "fixed", "lease requires the fixed algorithm"
+    assert not (backend and (lease or batch)), "lease and batch require the default redis backend"
+    assert not backend or algorithm == "fixed", "backends count fixed windows only"
+    algorithm = ALGORITHMS[algorithm]
+    leases = LeaseTable(lease) if lease else None
+    if batch:
+        assert type(batch) in (bool, int) and batch > 0, "batch must be True or microseconds > 0"
+        batch = PipelineBatch(0 if batch is True else batch / 1000000.0)
 
     def wrapper(method):
         @functools.wraps(method)
         def limit(self, *args, **kwargs):
-            tokens, refresh = user if self.current_user else guest
+            if adaptive is None:
+                return _limit(self, *args, **kwargs)
+
+            started = time()
+            result = _limit(self, *args, **kwargs)
+            if is_future(result):
+                result.add_done_callback(lambda future: adaptive.observe(time() - started))
+            else:
+                adaptive.observe(time() - started)
+            return result
+
+        def _limit(self, *args, **kwargs):
+            policy = networks.lookup(self.request.remote_ip) if networks else None
+            if policy == EXEMPT:
+                return method(self, *args, **kwargs)
+            elif policy == DENY:
+                if allowed(self, 0, -1, 0):
+                    return method(self, *args, **kwargs)
+                return
+
+            tokens, refresh = (policy or (user, guest))[0 if self.current_user else 1]
             if tokens is None:
                 return method(self, *args, **kwargs)
+            shed = tokens - adaptive.scale(tokens, bool(self.current_user)) if adaptive else 0
 
             # --------------
             # Get IP Address
@@ -41,23 +683,23 @@ def ratelimited(user=None, guest=None, redis_key_format="ratelimited.%s"):
             # ----------------
             # Check Rate Limit
             # ----------------
-            r = self.redis
-            current = r.get(redis_key)
-            if current is None:
-                r.setex(redis_key, tokens-1, refresh)
-                remaining, ttl = tokens-1, refresh
+            if backend:
+                result = None
+                check = functools.partial(backend.check, redis_key, tokens, refresh)
+            elif leases:
+                result = leases.take(redis_key)
+                if result is None:
+                    check = functools.partial(leases.acquire, self.redis, redis_key, tokens, refresh)
             else:
-                remaining, ttl = int(r.decr(redis_key) or 0), int(r.ttl(redis_key) or 0)
-
-            # set headers
-            self.set_header("X-RateLimit-Limit", tokens)
-            self.set_header("X-RateLimit-Remaining", (0 if remaining < 0 else remaining))
-            self.set_header("X-RateLimit-Reset", ttl)
+                result = None
+                check = functools.partial(batch.evalsha if batch else evalsha, self.redis, *algorithm(redis_key, tokens, refresh))
+            if result is None:
+                result = breaker.call(check) if breaker else check()
+            if is_future(result):
+                return _limit_async(self, result, tokens, shed, breaker, method, args, kwargs)
 
-            if remaining < 0:
-                do_continue = self.was_rate_limited(tokens, (0 if remaining < 0 else remaining), ttl)
-                if do_continue is not True:
-                    return
+            if not proceed(self, tokens, result, breaker, shed):
+                return
 
             # Continue with method
             return method(self, *args, **kwargs)
@@ -65,3 +707,74 @@ def ratelimited(user=None, guest=None, redis_key_format="ratelimited.%s"):
         return limit
 
     return wrapper
+
+
+def _release(handler, key, lease, on_finish):
+    try:
+        result = handler.redis.zrem(key, lease)
+        if is_future(result):
+            result.add_done_callback(_released)
+    except Exception:
+        traceback()
+    on_finish()
+
+
+def _released(future):
+    if future.exception() is not None:
+        traceback(future.exc_info())
+
+
+def _acquired(handler, limit, key, lease, result):
+    remaining, ttl = int(result[0] or 0), int(result[1] or 0)
+    if remaining < 0:
+        return handler.was_rate_limited(limit, 0, ttl) is True
+    handler.on_finish = functools.partial(_release, handler, key, lease, handler.on_finish)
+    return True
+
+
+@gen.coroutine
+def _concurrency_async(handler, future, limit, key, lease, method, args, kwargs):
+    result = yield future
+    if not _acquired(handler, limit, key, lease, result):
+        return
+
+    result = method(handler, *args, **kwargs)
+    if is_future(result):
+        result = yield result
+    raise gen.Return(result)
+
+
+def concurrency_limited(user=None, guest=None, expire=60, redis_key_format="concurrency.%s", key=None):
+    """Limit the requests in flight at once, per ip or `key(handler)`
+
+    Each request holds a lease in redis until `on_finish`, leases expire
+    after `expire` seconds so a crashed worker can not hold a slot forever.
+    Rejected requests go through `was_rate_limited(limit, 0, ttl)` where
+    ttl is the time until the oldest lease expires.
+
+    """
+    assert user is None or (type(user) is int and user > 0), "user must be int and > 0"
+    assert guest is None or (type(guest) is int and guest > 0), "guest must be int and > 0"
+    assert type(expire) is int and expire > 0, "expire must be int and > 0"
+
+    def wrapper(method):
+        @functools.wraps(method)
+        def limit(self, *args, **kwargs):
+            _limit = user if self.current_user else guest
+            if _limit is None:
+                return method(self, *args, **kwargs)
+
+            redis_key = redis_key_format % (key(self) if key else self.request.remote_ip)
+            lease = uuid4().hex
+            result = evalsha(self.redis, CONCURRENCY, CONCURRENCY_SHA, [redis_key], [_limit, expire, "%.3f" % time(), lease])
+            if is_future(result):
+                return _concurrency_async(self, result, _limit, redis_key, lease, method, args, kwargs)
+
+            if not _acquired(self, _limit, redis_key, lease, result):
+                return
+
+            return method(self, *args, **kwargs)
+
+        return limit
+
+    return wrapper
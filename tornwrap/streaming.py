@@ -0,0 +1,526 @@
+import re
+import zlib
+from json import loads
+from cgi import parse_header
+from tempfile import SpooledTemporaryFile
+from tornado.web import HTTPError
+from tornado.httputil import HTTPFile
+from tornado.httputil import HTTPHeaders
+from valideer import Object
+from valideer import Nullable
+from valideer import ValidationError
+from valideer import HomogeneousSequence
+
+from .compiler import CompiledObject
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRUCTURE = re.compile(r'["{}\[\],:]')
+IN_STRING = re.compile(r'["\\]')
+
+# Content-Encoding: zlib window bits
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "x-gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+# the body and the arrays directly inside it are streamed,
+# anything deeper is buffered and validated once complete
+STREAMED_DEPTH = 2
+
+VALUE, KEY, COLON, NEXT, DONE = range(5)
+PREAMBLE, BOUNDARY, HEADERS, DATA = range(5, 9)
+
+
+class Frame(object):
+    """An object or array being streamed"""
+    __slots__ = ("validator", "result", "key", "count", "seen")
+
+    def __init__(self, validator, result):
+        self.validator = validator
+        self.result = result
+        self.key = None
+        self.count = 0
+        self.seen = set()
+
+
+class JSONStream(object):
+    """Parses and validates a json body fed in chunks
+
+    Members of the top level object are validated as soon as they are
+    complete, arrays at the top level (or in one of its members) are
+    validated item by item and only the adapted values are kept.
+    The first invalid member raises `ValidationError`, malformed json
+    raises `HTTPError(400)`. With `many=True` the body is a list of records
+    and invalid records are collected in `errors` by index instead.
+    """
+    def __init__(self, schema, many=False):
+        if many:
+            # the body is a list of records, each buffered and validated on its own
+            self.schema = HomogeneousSequence(schema)
+            self.errors = {}
+        else:
+            self.schema = schema.schema if isinstance(schema, CompiledObject) else schema
+            self.errors = None
+        self.stack = []
+        self.state = VALUE
+        self.result = None
+        # the value being buffered
+        self.leaf = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        i, n = 0, len(chunk)
+        while i < n:
+            if self.leaf is not None:
+                i = self._scan(chunk, i)
+            else:
+                i = self._step(chunk, i)
+
+    def close(self):
+        """Returns the validated body once every chunk was fed
+        """
+        if self.leaf is not None and not self.stack and not self.depth and not self.in_string:
+            # ex. a bare number
+            self._end_leaf()
+        elif self.state == VALUE and not self.stack and self.leaf is None:
+            # empty body
+            self.state = DONE
+            self.result = self.schema.validate({})
+        if self.state != DONE:
+            raise HTTPError(400, "body was not able to be decoded")
+        if self.errors is not None:
+            return self.result, self.errors
+        return self.result
+
+    # -------
+    # Parsing
+    # -------
+    def _step(self, chunk, i):
+        i = WHITESPACE.match(chunk, i).end()
+        if i == len(chunk):
+            return i
+        char, state = chunk[i], self.state
+        frame = self.stack[-1] if self.stack else None
+
+        if state == VALUE:
+            if frame is not None and char == "]" and type(frame.result) is list and not frame.count:
+                return self._end_frame(i)
+            validator = self._validator()
+            if len(self.stack) < STREAMED_DEPTH and not (self.stack and self.errors is not None):
+                if char == "{" and type(validator) is Object:
+                    self.stack.append(Frame(validator, {}))
+                    self.state = KEY
+                    return i + 1
+                elif char == "[" and type(validator) is HomogeneousSequence and self._may_stream():
+                    self.stack.append(Frame(validator, []))
+                    return i + 1
+            return self._start_leaf(i)
+
+        elif state == KEY:
+            if char == "}" and not frame.count:
+                return self._end_frame(i)
+            elif char == '"':
+                return self._start_leaf(i)
+
+        elif state == COLON:
+            if char == ":":
+                self.state = VALUE
+                return i + 1
+
+        elif state == NEXT:
+            if char == ",":
+                self.state = KEY if type(frame.result) is dict else VALUE
+                return i + 1
+            elif char == ("}" if type(frame.result) is dict else "]"):
+                return self._end_frame(i)
+
+        raise HTTPError(400, "body was not able to be decoded")
+
+    def _start_leaf(self, i):
+        self.leaf = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        return i
+
+    def _scan(self, chunk, i):
+        """Buffers the current value up to the delimiter that ends it
+        """
+        start, n = i, len(chunk)
+        while i < n:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                    i += 1
+                    continue
+                match = IN_STRING.search(chunk, i)
+                if match is None:
+                    break
+                if match.group() == "\\":
+                    self.escaped = True
+                else:
+                    self.in_string = False
+                i = match.end()
+            else:
+                match = STRUCTURE.search(chunk, i)
+                if match is None:
+                    break
+                char = match.group()
+                if char == '"':
+                    self.in_string = True
+                elif char in "{[":
+                    self.depth += 1
+                elif self.depth and char in "}]":
+                    self.depth -= 1
+                elif not self.depth:
+                    # a delimiter of the enclosing frame
+                    self.leaf.append(chunk[start:match.start()])
+                    self._end_leaf()
+                    return match.start()
+                i = match.end()
+        self.leaf.append(chunk[start:n])
+        return n
+
+    def _end_leaf(self):
+        text, self.leaf = "".join(self.leaf), None
+        try:
+            value = loads(text)
+        except ValueError:
+            raise HTTPError(400, "body was not able to be decoded")
+        if self.state == KEY:
+            if not isinstance(value, basestring):
+                raise HTTPError(400, "body was not able to be decoded")
+            self.stack[-1].key = value
+            self.state = COLON
+        else:
+            self._add(value, validated=False)
+
+    def _end_frame(self, i):
+        frame = self.stack[-1]
+        validator = frame.validator
+        if type(frame.result) is dict:
+            missing = validator._required_keys.difference(frame.seen)
+            if missing:
+                self._raise(ValidationError("missing required properties: %s" % list(missing), frame.result))
+            for name, _validator in validator._named_validators:
+                if name not in frame.seen and isinstance(_validator, Nullable):
+                    default = _validator.default_object_property
+                    if default is not Nullable._UNDEFINED:
+                        frame.result[name] = default
+        elif validator._min_length is not None and frame.count < validator._min_length:
+            self._raise(ValidationError("must contain at least %d elements" % validator._min_length, frame.result))
+        self.stack.pop()
+        self._add(frame.result, validated=True)
+        return i + 1
+
+    # ----------
+    # Validation
+    # ----------
+    def _validator(self):
+        """The validator of the value about to be parsed, None for any value
+        """
+        if not self.stack:
+            return self.schema
+        frame = self.stack[-1]
+        if type(frame.result) is list:
+            return frame.validator._item_validator
+        for name, validator in frame.validator._named_validators:
+            if name == frame.key:
+                return validator
+        additional = frame.validator._additional
+        return None if isinstance(additional, bool) or additional is Object.REMOVE else additional
+
+    def _may_stream(self):
+        # an optional member that may be dropped on error has to be buffered
+        if not self.stack:
+            return True
+        validator = self.stack[-1].validator
+        return not validator._ignore_optional_errors or self.stack[-1].key in validator._required_keys
+
+    def _add(self, value, validated):
+        if not self.stack:
+            self.result = value if validated else self.schema.validate(value)
+            self.state = DONE
+            return
+
+        frame = self.stack[-1]
+        self.state = NEXT
+        if type(frame.result) is list:
+            validator = frame.validator
+            if validator._max_length is not None and frame.count >= validator._max_length:
+                self._raise(ValidationError("must contain at most %d elements" % validator._max_length, frame.result))
+            if not validated and validator._item_validator is not None:
+                try:
+                    value = validator._item_validator.validate(value)
+                except ValidationError as ex:
+                    if self.errors is None:
+                        self._raise(ex.add_context(frame.count))
+                    self.errors[frame.count] = ex
+                    frame.count += 1
+                    return
+            frame.result.append(value)
+            frame.count += 1
+            return
+
+        key, schema = frame.key, frame.validator
+        frame.seen.add(key)
+        frame.count += 1
+        if key not in schema._all_keys:
+            if schema._additional is Object.REMOVE:
+                return
+            elif schema._additional is False:
+                self._raise(ValidationError("additional properties: %s" % [key], frame.result))
+        validator = None if validated else self._validator()
+        if validator is not None:
+            try:
+                value = validator.validate(value)
+            except ValidationError as ex:
+                if schema._ignore_optional_errors and key in schema._all_keys and key not in schema._required_keys:
+                    frame.result.pop(key, None)
+                    return
+                self._raise(ex.add_context(key))
+        frame.result[key] = value
+
+    def _raise(self, error):
+        """Adds the keys and indexes of the enclosing frames to the error
+        """
+        for frame in reversed(self.stack[:-1]):
+            error.add_context(frame.count if type(frame.result) is list else frame.key)
+        raise error
+
+
+class SpooledFile(HTTPFile):
+    """An `HTTPFile` whose `body` is read from its spooled `file`"""
+    @property
+    def body(self):
+        self.file.seek(0)
+        try:
+            return self.file.read()
+        finally:
+            self.file.seek(0)
+
+
+class MultipartStream(object):
+    """Parses a multipart/form-data body fed in chunks
+
+    Fields are kept in memory (up to `max_field_size` bytes each) and
+    validated with the schema once the body is complete. Files are written
+    to a `SpooledTemporaryFile` that moves to disk past `spool_size` bytes
+    and are validated with the fields as `SpooledFile(filename, content_type,
+    file, size)`, so memory stays bounded whatever the size of the upload.
+    Like a buffered `HTTPFile` its `body` holds the content (read on access).
+    """
+    def __init__(self, schema, boundary, spool_size=1 << 20, max_field_size=1 << 16):
+        self.schema = schema
+        self.delimiter = b"\r\n--" + boundary
+        self.spool_size = spool_size
+        self.max_field_size = max_field_size
+        # so the first boundary reads like the others
+        self.buffer = b"\r\n"
+        self.state = PREAMBLE
+        self.fields = {}
+        self.files = {}
+        self.part = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        while self._next():
+            pass
+
+    def close(self):
+        """Returns the validated fields and files
+        """
+        if self.state != DONE:
+            self._error()
+        fields = dict([(k, map(b"".join, v)) for k, v in self.fields.items()])
+        body = dict([(k, v[0] if len(v) == 1 else v) for k, v in fields.items()])
+        for name, files in self.files.items():
+            for _file in files:
+                _file.file.seek(0)
+            # validated with the fields, as decode_multipart does
+            body[name] = files[0] if len(files) == 1 else files
+        return self.schema.validate(body)
+
+    def cleanup(self):
+        for files in self.files.values():
+            for _file in files:
+                _file.file.close()
+
+    def _next(self):
+        """Consumes the buffer up to the next state, False if more data is needed
+        """
+        state, buffer = self.state, self.buffer
+        if state in (PREAMBLE, DATA):
+            end = buffer.find(self.delimiter)
+            if end == -1:
+                # keep what could be the start of a delimiter
+                keep = len(self.delimiter) - 1
+                if len(buffer) > keep:
+                    self._write(buffer[:-keep])
+                    self.buffer = buffer[-keep:]
+                return False
+            self._write(buffer[:end])
+            self.buffer = buffer[end + len(self.delimiter):]
+            self.part = None
+            self.state = BOUNDARY
+
+        elif state == BOUNDARY:
+            if len(buffer) < 2:
+                return False
+            elif buffer[:2] == b"--":
+                self.buffer, self.state = b"", DONE
+                return False
+            elif buffer[:2] != b"\r\n":
+                self._error()
+            self.buffer = buffer[2:]
+            self.state = HEADERS
+
+        elif state == HEADERS:
+            end = buffer.find(b"\r\n\r\n")
+            if end == -1:
+                if len(buffer) > self.max_field_size:
+                    self._error()
+                return False
+            self._start_part(buffer[:end])
+            self.buffer = buffer[end + 4:]
+            self.state = DATA
+
+        else:
+            # epilogue
+            self.buffer = b""
+            return False
+        return True
+
+    def _start_part(self, headers):
+        headers = HTTPHeaders.parse(headers.decode("utf-8"))
+        disposition, params = parse_header(headers.get("Content-Disposition", ""))
+        if disposition != "form-data" or not params.get("name"):
+            self._error()
+        if "filename" in params:
+            self.part = SpooledFile(filename=params["filename"],
+                                    content_type=headers.get("Content-Type", "application/octet-stream"),
+                                    file=SpooledTemporaryFile(max_size=self.spool_size),
+                                    size=0)
+            self.files.setdefault(params["name"], []).append(self.part)
+        else:
+            self.part = []
+            self.fields.setdefault(params["name"], []).append(self.part)
+
+    def _write(self, data):
+        part = self.part
+        if part is None or not data:
+            # preamble
+            return
+        elif type(part) is list:
+            part.append(data)
+            if sum(map(len, part)) > self.max_field_size:
+                raise HTTPError(413, "multipart field larger than %d bytes" % self.max_field_size)
+        else:
+            part.file.write(data)
+            part.size += len(data)
+
+    def _error(self):
+        raise HTTPError(400, "body was not able to be decoded as multipart/form-data")
+
+
+class Inflater(object):
+    """Decompresses a gzip or deflate body in chunks
+
+    Raises `HTTPError(413)` as soon as more than `max_size` bytes come out,
+    so a small compressed body cannot expand into memory unbounded.
+    With a `stream` it can stand in for it, feeding it the inflated bytes.
+    """
+    def __init__(self, encoding, max_size, stream=None):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.stream = stream
+        self.size = 0
+        self.started = False
+        self.decompressor = zlib.decompressobj(ENCODINGS[encoding])
+
+    def decompress(self, chunk):
+        try:
+            # at most one byte over the limit
+            data = self.decompressor.decompress(chunk, self.max_size - self.size + 1)
+        except zlib.error:
+            if self.encoding == "deflate" and not self.started:
+                # raw deflate, sent without the zlib header
+                self.started = True
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decompress(chunk)
+            raise HTTPError(400, "body was not able to be decoded as %s" % self.encoding)
+        self.started = True
+        return self._count(data)
+
+    def flush(self):
+        return self._count(self.decompressor.flush())
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise HTTPError(413, "body larger than %d bytes once decompressed" % self.max_size)
+        return data
+
+    def feed(self, chunk):
+        self.stream.feed(self.decompress(chunk))
+
+    def close(self):
+        self.stream.feed(self.flush())
+        return self.stream.close()
+
+    def cleanup(self):
+        if hasattr(self.stream, "cleanup"):
+            self.stream.cleanup()
+
+
+class StreamedBody(object):
+    """Mixin for `@stream_request_body` handlers whose methods use
+    `@validated(body=..., streamed=True)`, the body is validated as it arrives
+
+    json bodies are validated member by member, multipart files
+    over `spool_size` bytes are written to temporary files and gzip or
+    deflate bodies are decompressed as they arrive. With a logged
+    `ValidationProfile` the fields' time is added to the request's log line.
+    """
+    spool_size = 1 << 20
+    max_field_size = 1 << 16
+    _body_stream = None
+    _body_profile = None
+
+    def data_received(self, chunk):
+        if self._finished:
+            # already rejected, drop the rest
+            return
+        try:
+            if self._body_stream is None:
+                method = getattr(self, self.request.method.lower(), None)
+                schema = getattr(method, "streamed_body", None)
+                if schema is None:
+                    raise HTTPError(400, reason="No body arguments allowed")
+                _type, params = parse_header(self.request.headers.get("Content-Type", ""))
+                if _type == "multipart/form-data" and not method.many:
+                    if not params.get("boundary"):
+                        raise HTTPError(400, "body was not able to be decoded as multipart/form-data")
+                    self._body_stream = MultipartStream(schema, params["boundary"], self.spool_size, self.max_field_size)
+                elif method.many:
+                    self._body_stream = JSONStream(schema, many=True)
+                else:
+                    self._body_stream = JSONStream(schema)
+                encoding = self.request.headers.get("Content-Encoding", "").strip().lower()
+                if encoding in ENCODINGS:
+                    self._body_stream = Inflater(encoding, method.max_body_size, self._body_stream)
+                if method.profile is not None:
+                    self._body_profile = method.profile
+                    self._log_validation = dict(validation={})
+            if self._body_profile is None:
+                self._body_stream.feed(chunk)
+            else:
+                with self._body_profile.timing(self._log_validation["validation"]):
+                    self._body_stream.feed(chunk)
+        except Exception as e:
+            self._handle_request_exception(e)
+
+    def on_finish(self):
+        if self._body_stream is not None and hasattr(self._body_stream, "cleanup"):
+            self._body_stream.cleanup()
+        super(StreamedBody, self).on_finish()
@@ -1,13 +1,255 @@
+from copy import copy
+from copy import deepcopy
+from time import time
+from threading import Lock
+from threading import local
+from contextlib import contextmanager
+from array import array
+from types import NoneType
 from valideer import parse
+from valideer import AllOf
+from valideer import AnyOf
+from valideer import Boolean
+from valideer import ChainOf
+from valideer import Date
+from valideer import Datetime
+from valideer import Enum
+from valideer import HeterogeneousSequence
+from valideer import Integer
+from valideer import Mapping
+from valideer import NonNullable
+from valideer import Nullable
+from valideer import Number
+from valideer import Object
+from valideer import Pattern
+from valideer import Range
+from valideer import String
+from valideer import Time
+from valideer import Type
+from valideer import Validator
+from valideer import ValidationError
+from valideer import HomogeneousSequence
 from functools import wraps
 from urlparse import parse_qs
 from tornado.web import HTTPError
 from tornado.escape import json_decode
+from tornado.httputil import parse_body_arguments
 
 from .validators import *
+from .helpers import LRUCache
+from .helpers import query_arguments
+from .compiler import compile_schema
+from .streaming import Inflater
+from .streaming import JSONStream
+from .streaming import ENCODINGS
 
+# same default as tornado's HTTPServer
+MAX_BODY_SIZE = 100 * 1024 * 1024
 
-def validated(arguments=None, body=None, extra_arguments=True, extra_body=False):
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+def decode_json(request):
+    return json_decode(request.body)
+
+
+def decode_form(request):
+    # ex. key1=value2&key2=value2
+    return dict([(k, v[0] if len(v) == 1 else v) for k, v in parse_qs(request.body, strict_parsing=True).items()])
+
+
+def decode_multipart(request):
+    # tornado parsed the parts when the request was read
+    body = dict([(k, v[0] if len(v) == 1 else v) for k, v in request.body_arguments.items()])
+    body.update([(k, v[0] if len(v) == 1 else v) for k, v in request.files.items()])
+    return body
+
+
+def decode_msgpack(request):
+    return msgpack.unpackb(request.body)
+
+
+# Content-Type: decoder(request) returning the body to validate
+DECODERS = {
+    "application/json": decode_json,
+    "application/x-www-form-urlencoded": decode_form,
+    "multipart/form-data": decode_multipart,
+}
+if msgpack:
+    DECODERS["application/msgpack"] = DECODERS["application/x-msgpack"] = decode_msgpack
+
+
+def content_type(request):
+    """Returns the Content-Type that decodes the request body
+    """
+    _type = request.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+    start = request.body.lstrip()[:1]
+    if _type in DECODERS and not (_type == "application/x-www-form-urlencoded" and start in ("{", "[")):
+        return _type
+    # missing, unknown or json posted as a form (ex. `curl -d`)
+    return "application/json" if start in ("{", "[", '"') else "application/x-www-form-urlencoded"
+
+
+def inflate(request, max_size):
+    """Replaces a gzip or deflate request body with the decompressed one
+    """
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if encoding in ENCODINGS:
+        inflater = Inflater(encoding, max_size)
+        request.body = inflater.decompress(request.body) + inflater.flush()
+        del request.headers["Content-Encoding"]
+        if request.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            # tornado could not parse the compressed parts
+            parse_body_arguments(request.headers["Content-Type"], request.body, request.body_arguments, request.files)
+
+
+def validate_many(schema, records):
+    """Validates each record on its own, returns the valid ones (in order)
+    and the errors of the others by index
+    """
+    HomogeneousSequence().validate(records)
+    valid, errors, validate = [], {}, schema.validate
+    for index, record in enumerate(records):
+        try:
+            valid.append(validate(record))
+        except ValidationError as e:
+            errors[index] = e
+    return valid, errors
+
+
+class ValidationProfile(object):
+    """Cumulative calls and time of each schema field ("body.user.email")
+    and validator class, for `@validated(..., profile=...)`
+
+    With `log=True` the fields' time of each request is added to its log
+    line as `validation: {field: ms}`.
+    """
+    def __init__(self, log=False):
+        self.log = log
+        self._lock = Lock()
+        self._local = local()
+        self.reset()
+
+    def record(self, field, validator, elapsed):
+        with self._lock:
+            for stats, key in ((self.fields, field), (self.validators, validator)):
+                entry = stats.get(key)
+                if entry is None:
+                    entry = stats[key] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += elapsed
+        timings = getattr(self._local, "timings", None)
+        if timings is not None:
+            timings[field] = timings.get(field, 0.0) + elapsed * 1000
+
+    @contextmanager
+    def timing(self, timings):
+        """Adds the fields' time (ms) of what is validated within to the
+        `timings` of one request, validation does not yield to the IOLoop
+        """
+        previous, self._local.timings = getattr(self._local, "timings", None), timings
+        try:
+            yield timings
+        finally:
+            self._local.timings = previous
+
+    def stats(self):
+        """Returns {"fields": {field: {"calls", "ms"}}, "validators": {class name: {"calls", "ms"}}}
+        """
+        with self._lock:
+            return dict([(name, dict([(key, dict(calls=calls, ms=elapsed * 1000))
+                                      for key, (calls, elapsed) in stats.items()]))
+                         for name, stats in (("fields", self.fields), ("validators", self.validators))])
+
+    def reset(self):
+        with self._lock:
+            self.fields, self.validators = {}, {}
+
+
+validation_profile = ValidationProfile()
+
+
+def profiled(schema, profile, field, timed=True):
+    """Returns a copy of `schema` recording the time of its validation, and of
+    each field of an object schema, into `profile`
+    """
+    schema = copy(schema)
+    if type(schema) is Object:
+        schema._named_validators = [(key, profiled(validator, profile, "%s.%s" % (field, key)))
+                                    for key, validator in schema._named_validators]
+    if timed:
+        validate, name = schema.validate, type(schema).__name__
+
+        def timed_validate(value, adapt=True):
+            started = time()
+            try:
+                return validate(value, adapt)
+            finally:
+                profile.record(field, name, time() - started)
+        # an instance attribute, so isinstance checks (ex. Nullable defaults) still apply
+        schema.validate = timed_validate
+    return schema
+
+
+def logged(method, profile):
+    """Adds the fields' time of the request to the handler's log line
+    """
+    @wraps(method)
+    def validate(self, *args, **kwargs):
+        # a streamed body started it as the chunks arrived
+        if not hasattr(self, "_log_validation"):
+            self._log_validation = dict(validation={})
+        with profile.timing(self._log_validation["validation"]):
+            return method(self, *args, **kwargs)
+    return validate
+
+
+# valideer's validators that only look at the value, not `Condition`, `AdaptBy` or `AdaptTo`
+PURE = set([AllOf, AnyOf, Boolean, ChainOf, Date, Datetime, Enum, HeterogeneousSequence, HomogeneousSequence,
+            Integer, Mapping, NonNullable, Nullable, Number, Object, Pattern, Range, String, Time, Type])
+
+
+def pure(schema):
+    """Whether the schema always adapts the same value to the same result,
+    only when each of its validators is in `PURE` or its class sets
+    `pure = True` (subclasses have to set it again)
+    """
+    if type(schema) not in PURE and vars(type(schema)).get("pure") is not True:
+        return False
+    children = [getattr(schema, name, None) for name in ("schema", "_validator", "_item_validator",
+                                                         "_key_validator", "_value_validator", "_additional")]
+    children += getattr(schema, "_validators", None) or []
+    children += getattr(schema, "_item_validators", None) or []
+    children += [validator for _, validator in getattr(schema, "_named_validators", None) or []]
+    return all(pure(child) for child in children if isinstance(child, Validator))
+
+
+# adapted values returned as they are, lists of them (url arguments are flat) sliced, anything else deep copied
+IMMUTABLE = (str, unicode, int, long, float, bool, NoneType)
+SEQUENCES = (list, array)
+
+
+def validate_arguments(schema, query):
+    return schema.validate(query)
+
+
+def arguments_key(schema, query):
+    # the (filtered) query, ex. ?b=2&a=1&_=1417978116609 and ?a=1&b=2 share one entry
+    return tuple(sorted([(k, tuple(v) if type(v) is list else v) for k, v in query.iteritems()]))
+
+
+def copy_arguments(result):
+    if type(result) is not dict:
+        return deepcopy(result)
+    return dict([(k, v if type(v) in IMMUTABLE else v[:] if type(v) in SEQUENCES else deepcopy(v))
+                 for k, v in result.iteritems()])
+
+
+def validated(arguments=None, body=None, extra_arguments=True, extra_body=False, compiled=False, streamed=False,
+              max_body_size=MAX_BODY_SIZE, many=False, profile=None, cache=None):
     if type(body) in (dict, str):
         body = parse(body, additional_properties=extra_body)
     elif body not in (None, False):
@@ -16,6 +258,19 @@ def validated(arguments=None, body=None, extra_arguments=True, extra_body=False)
         arguments = parse(arguments, additional_properties=extra_arguments)
     elif arguments not in (None, False):
         raise ValueError('arguments must be type None, False, or dict')
+    if profile is True:
+        profile = validation_profile
+    if profile:
+        # objects are compiled below, their fields are timed instead
+        body = profiled(body, profile, "body", type(body) is not Object) if body else body
+        arguments = profiled(arguments, profile, "arguments", type(arguments) is not Object) if arguments else arguments
+    if compiled or many:
+        # same results and errors, fewer calls per request
+        body = compile_schema(body) if body else body
+        arguments = compile_schema(arguments) if arguments else arguments
+    if cache:
+        assert arguments and pure(arguments), "cache requires an arguments schema of validators marked `pure = True`"
+    cache = LRUCache(validate_arguments, arguments_key, copy_arguments, cache) if cache else None
 
     def wrapper(method):
         @wraps(method)
@@ -23,17 +278,34 @@ def validated(arguments=None, body=None, extra_arguments=True, extra_body=False)
             # ------------------
             # Validate Body Data
             # ------------------
-            if body:
-                try:
-                    _body = json_decode(self.request.body) if self.request.body else {}
-                except:
-                    # ex. key1=value2&key2=value2
+            # fed by StreamedBody.data_received, which is not called for an empty body
+            stream = getattr(self, '_body_stream', None) if streamed else None
+            # without @stream_request_body the body was read already (a future otherwise)
+            buffered = streamed and stream is None and isinstance(self.request.body, bytes) and self.request.body
+            if body and streamed and not buffered:
+                if stream is None:
+                    stream = JSONStream(body, many=many)
+                if many:
+                    kwargs['body'], kwargs['errors'] = stream.close()
+                else:
+                    kwargs['body'] = stream.close()
+
+            elif body:
+                if self.request.body:
+                    inflate(self.request, max_body_size)
+                    _type = content_type(self.request)
                     try:
-                        _body = dict([(k, v[0] if len(v) == 1 else v) for k, v in parse_qs(self.request.body, strict_parsing=True).items()])
+                        _body = DECODERS[_type](self.request)
                     except:
-                        raise HTTPError(400, "body was not able to be decoded")
+                        raise HTTPError(400, "body was not able to be decoded as %s" % _type)
+                else:
+                    _body = {}
 
-                kwargs['body'] = body.validate(_body, adapt=True)
+                if many:
+                    # a list of records, the invalid ones are reported in `errors`
+                    kwargs['body'], kwargs['errors'] = validate_many(body, _body)
+                else:
+                    kwargs['body'] = body.validate(_body, adapt=True)
 
             elif body is False and self.request.body:
                 raise HTTPError(400, reason='No body arguments allowed')
@@ -43,16 +315,24 @@ def validated(arguments=None, body=None, extra_arguments=True, extra_body=False)
             # -------------------
             if arguments:
                 # include url arguments
-                if self.request.query_arguments:
-                    _arguments = dict([(k, v[0] if len(v) == 1 else v) for k, v in self.request.query_arguments.items() if v != [''] and k[0] != '_'])
+                if cache is not None:
+                    kwargs["arguments"] = cache.get(arguments, query_arguments(self.request))
                 else:
-                    _arguments = {}
-                kwargs["arguments"] = arguments.validate(_arguments)
+                    kwargs["arguments"] = arguments.validate(query_arguments(self.request))
 
-            elif arguments is False and self.request.query_arguments and not any(map(lambda a: a[0] == '_', self.request.query_arguments)):
+            elif arguments is False and query_arguments(self.request):
                 raise HTTPError(400, reason='No url arguments allowed')
 
             return method(self, *args, **kwargs)
 
+        if streamed:
+            validate.streamed_body = body
+            validate.max_body_size = max_body_size
+            validate.many = many
+            validate.profile = profile if profile and profile.log else None
+        if profile and profile.log:
+            validate = logged(validate, profile)
+        if cache is not None:
+            validate.arguments_cache = cache
         return validate
     return wrapper
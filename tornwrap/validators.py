@@ -1,11 +1,229 @@
 import re
 import os
+import json
+import tempfile
+from time import time
+from types import InstanceType
+from array import array
+from threading import Lock
+from datetime import datetime
+from datetime import timedelta
 from valideer import *
 import timestring
 
+from .helpers import LRUCache
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+class ParseCache(LRUCache):
+    """Thread safe LRU of parsed `timestring.Date` and `timestring.Range` values,
+    ex. `get(timestring.Range, "last 7 days")`
+
+    Keys include the time bucket (`resolution` seconds) of the parse so
+    relative values, ex. "last 7 days", are parsed again once it changes.
+    Values are returned as copies so callers can not change the cache.
+    """
+    def __init__(self, size=1024, resolution=1):
+        super(ParseCache, self).__init__(self._parse, self._key, self._copy, size)
+        self.resolution = resolution
+
+    @staticmethod
+    def _parse(parse, value, tz=None):
+        return parse(value, tz=tz)
+
+    def _key(self, parse, value, tz=None):
+        if type(value) in (str, unicode):
+            return (parse, value, tz, int(time() // self.resolution))
+
+    def _copy(self, result):
+        # attributes are datetimes, strings and tzinfos, only Range holds mutable Dates
+        clone = result.__class__.__new__(result.__class__)
+        clone.__dict__.update(result.__dict__)
+        if isinstance(result, timestring.Range):
+            clone._dates = (self._copy(result._dates[0]), self._copy(result._dates[1]))
+        return clone
+
+
+timestring_cache = ParseCache()
+
+# 2015-01-15, 2015-01-15T10:30 or 2015-01-15 10:30:00Z
+ISO_8601 = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?Z?)?$")
+EPOCH = re.compile(r"^\d{10}$")
+
+
+def _datetime(value):
+    """Returns the datetime of an ISO-8601 date, datetime or epoch, None for anything else
+    """
+    if type(value) in (str, unicode):
+        match = ISO_8601.match(value)
+        if match:
+            try:
+                return datetime(*[int(x) for x in match.groups() if x is not None])
+            except ValueError as e:
+                # ex. 2015-02-30
+                raise timestring.TimestringInvalid(str(e))
+        elif EPOCH.match(value):
+            return datetime.fromtimestamp(int(value))
+    elif type(value) in (int, long, float) and 1000000000 <= value < 10000000000:
+        return datetime.fromtimestamp(value)
+
+
+def parse_date(value, tz=None):
+    """Returns a `timestring.Date`, machine formats (ISO-8601 and epochs)
+    are parsed directly, anything else by timestring
+    """
+    if type(value) in (int, long):
+        # as fast in timestring
+        return timestring.Date(value, tz=tz)
+    _date = _datetime(value)
+    if _date is None:
+        return timestring_cache.get(timestring.Date, value, tz=tz)
+    return timestring.Date(_date, tz=tz)
+
+
+def parse_range(value, tz=None):
+    """Returns a `timestring.Range`, a single ISO-8601 date or epoch covers
+    the next 24 hours and "start,end" ranges both, anything else is parsed by timestring
+    """
+    if type(value) in (str, unicode) and value.count(",") == 1:
+        start, end = map(_datetime, value.split(","))
+        if start is not None and end is not None:
+            return timestring.Range(timestring.Date(start, tz=tz), timestring.Date(end, tz=tz))
+    else:
+        start = _datetime(value)
+        if start is not None:
+            return timestring.Range(timestring.Date(start, tz=tz), timestring.Date(start + timedelta(days=1), tz=tz))
+    return timestring_cache.get(timestring.Range, value, tz=tz)
+
+
+# +05:30, -4, 0530, UTC+5 or GMT-03:00
+UTC_OFFSET = re.compile(r"^(?:UTC|GMT)?([+-]?)(\d{1,2})(?::?(\d{2}))?$")
+
+
+def _offset(minutes):
+    return "%s%02d:%02d" % ("-" if minutes < 0 else "+", abs(minutes) // 60, abs(minutes) % 60)
+
+
+def utc_offset(value):
+    """Returns the offset formatted as +HH:MM, None if it is not one
+    """
+    match = UTC_OFFSET.match(value)
+    if match:
+        sign, hours, minutes = match.groups()
+        if int(hours) <= 14 and int(minutes or 0) < 60:
+            return _offset((-1 if sign == "-" else 1) * (int(hours) * 60 + int(minutes or 0)))
+
+
+class TimezoneIndex(object):
+    """Case insensitive index from the tz database names, their abbreviations
+    and UTC offsets to canonical names
+
+    Built on first use and saved in the temp directory, so the other
+    processes of the user load it instead of building it again.
+    Abbreviations used by zones with different offsets (ex. CST) are left out.
+    """
+    # picked for an abbreviation or offset shared by several zones
+    preferred = ("America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles",
+                 "America/Anchorage", "America/Halifax", "America/St_Johns", "Europe/London",
+                 "Europe/Berlin", "Europe/Moscow", "Africa/Johannesburg", "Africa/Lagos",
+                 "Africa/Nairobi", "Africa/Maputo", "Asia/Kolkata", "Asia/Jakarta", "Asia/Shanghai",
+                 "Asia/Tokyo", "Asia/Seoul", "Australia/Sydney", "Australia/Adelaide",
+                 "Pacific/Auckland", "Pacific/Honolulu")
+
+    def __init__(self, path=None):
+        self.path = path
+        self._index = None
+        self._lock = Lock()
+
+    def get(self, value):
+        index = self._index or self.load()
+        value = value.strip().upper()
+        return index.get(value) or index.get(utc_offset(value))
+
+    def load(self):
+        with self._lock:
+            if self._index is None:
+                import pytz
+                path = self.path or os.path.join(tempfile.gettempdir(), "tornwrap-timezones-%s.json" % pytz.__version__)
+                try:
+                    self._index = self.read(path)
+                except (IOError, OSError, ValueError):
+                    pass
+                if self._index is None:
+                    self._index = self.build()
+                    try:
+                        # a new file, never one planted (or linked) by another user
+                        temp = "%s.%d" % (path, os.getpid())
+                        with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), "w") as f:
+                            json.dump(self._index, f)
+                        os.rename(temp, path)
+                    except (IOError, OSError):  # pragma: no cover
+                        pass
+        return self._index
+
+    def read(self, path):
+        """Returns the saved index, None unless it was written by this user
+        and only holds tz database names
+        """
+        with os.fdopen(os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))) as f:
+            stat = os.fstat(f.fileno())
+            if hasattr(os, "getuid") and (stat.st_uid != os.getuid() or stat.st_mode & 0o022):
+                return None
+            index = json.load(f)
+        import pytz
+        if type(index) is dict and all(value in pytz.all_timezones_set for value in index.itervalues()):
+            return index
+
+    def build(self):
+        import pytz
+        now = datetime.now()
+        abbreviations, offsets = {}, {}
+        for name in pytz.common_timezones:
+            zone = pytz.timezone(name)
+            seen = set()
+            for moment in (datetime(now.year, 1, 15), datetime(now.year, 7, 15)):
+                moment = zone.localize(moment)
+                offset = _offset(int(moment.utcoffset().total_seconds()) // 60)
+                seen.add(offset)
+                if moment.tzname()[0] not in "+-":
+                    abbreviations.setdefault(moment.tzname().upper(), {}).setdefault(offset, []).append(name)
+            if len(seen) == 1:
+                # no daylight saving time
+                offsets.setdefault(seen.pop(), []).append(name)
+
+        index = {}
+        for offset, names in offsets.items():
+            hours, minutes = int(offset[1:3]), int(offset[4:])
+            if not minutes:
+                # Etc/GMT zones have the sign inverted
+                index[offset] = "Etc/GMT%s%d" % ("-" if offset[0] == "+" else "+", hours) if hours else "UTC"
+            else:
+                index[offset] = self._pick(names)
+        for abbreviation, zones in abbreviations.items():
+            if len(zones) == 1:
+                names = zones.values()[0]
+                index[abbreviation] = abbreviation if abbreviation in pytz.all_timezones_set else self._pick(names)
+        for name in pytz.all_timezones:
+            index[name.upper()] = name
+        return index
+
+    def _pick(self, names):
+        for name in self.preferred:
+            if name in names:
+                return name
+        return names[0]
+
+
+timezone_index = TimezoneIndex()
+
 
 class boolean(Validator):
     name = "bool"
+    pure = True
     true = ("y", "yes", "1", "t", "true", "on")
     false = ("n", "no", "0", "f", "false", "off")
 
@@ -23,6 +241,7 @@ class boolean(Validator):
 
 class timezone(String):
     name = "timezone"
+    pure = True
     timezones = {
         "US/EASTERN": "US/Eastern", "EST": "US/Eastern",  "-4": "US/Eastern",
         "US/CENTRAL": "US/Central", "CST": "US/Central", "-5": "US/Central",
@@ -33,7 +252,7 @@ class timezone(String):
 
     def validate(self, value, adapt=True):
         super(timezone, self).validate(value)
-        result = self.timezones.get(value.upper())
+        result = self.timezones.get(value.upper()) or timezone_index.get(value)
         if result:
             return result if adapt else value
         else:
@@ -42,11 +261,13 @@ class timezone(String):
 
 class uuid(Pattern):
     name = "uuid"
+    pure = True
     regexp = re.compile(r"^[0-9a-f]{8}(-?[0-9a-f]{4}){3}-?[0-9a-f]{12}$")
 
 
 class _id(Pattern):
     name = "id"
+    pure = True
     regexp = re.compile(r"^[1-9]\d*$")
 
     def validate(self, value, adapt=True):
@@ -56,11 +277,13 @@ class _id(Pattern):
 
 class url(Pattern):
     name = "url"
+    pure = True
     regexp = re.compile(r"^(https?:\/\/)")
 
 
 class _file(String):
     name = "file"
+    pure = False
 
     def validate(self, value, adapt=True):
         super(_file, self).validate(value, adapt)
@@ -72,6 +295,7 @@ class _file(String):
 
 class branch(String):
     name = "branch"
+    pure = True
 
     def validate(self, value, adapt=True):
         super(branch, self).validate(value, adapt)
@@ -84,16 +308,19 @@ class branch(String):
 
 class handler(Pattern):
     name = "handler"
+    pure = True
     regexp = re.compile(r"^[\w\-\.]{1,255}$")
 
 
 class slug(Pattern):
     name = "slug"
+    pure = True
     regexp = re.compile(r"^[\w\-\.]{1,255}\/[\w\-\.]{1,255}$")
 
 
 class email(Pattern):
     name = "email"
+    pure = True
     regexp = re.compile(r".+@.+\..+", re.I)
 
     def validate(self, value, adapt=True):
@@ -103,6 +330,7 @@ class email(Pattern):
 
 class percent(Pattern):
     name = 'percent'
+    pure = True
     regexp = re.compile(r"^\d{1,45}(\.\d{1,25})?\%?$")
 
     def validate(self, value, adapt=True):
@@ -118,6 +346,7 @@ class percent(Pattern):
 
 class commit(Pattern):
     name = "commit"
+    pure = True
     regexp = re.compile(r"^\d+:\w{12}|\w{40}$")
 
     def validate(self, value, adapt=True):
@@ -125,18 +354,151 @@ class commit(Pattern):
         return str(value).lower()
 
 
-class ref(Validator):
+def _screen_type(validator):
+    return validator.accept_types, validator.reject_types, None, None
+
+
+def _screen_string(validator):
+    low, high = validator._min_length, validator._max_length
+    if low is None and high is None:
+        return _screen_type(validator)
+
+    def check(value):
+        return (low is None or len(value) >= low) and (high is None or len(value) <= high)
+    return validator.accept_types, validator.reject_types, check, None
+
+
+def _screen_pattern(validator):
+    return validator.accept_types, validator.reject_types, validator.regexp.match, validator.regexp
+
+
+def _screen_enum(validator):
+    values = validator.values
+
+    def check(value):
+        try:
+            return value in values
+        except TypeError:  # unhashable
+            return False
+    return None, None, check, None
+
+
+# validate function: returns (accept_types, reject_types, check, regexp)
+# a value failing any of them would be rejected by the validator
+SCREENS = {
+    Type.validate.im_func: _screen_type,
+    String.validate.im_func: _screen_string,
+    Pattern.validate.im_func: _screen_pattern,
+    Enum.validate.im_func: _screen_enum,
+    timezone.validate.im_func: _screen_type,
+    _file.validate.im_func: _screen_type,
+    branch.validate.im_func: _screen_type,
+    email.validate.im_func: _screen_pattern,
+    commit.validate.im_func: _screen_pattern,
+}
+
+# patterns with flags or group references change meaning when joined
+UNCOMBINABLE = re.compile(r"\(\?[^:]|\\[1-9]")
+
+
+class Union(Validator):
+    """`AnyOf` that picks the alternative up front instead of trying each one
+
+    Each alternative is screened by its types, length, enum values or
+    pattern (see `SCREENS`) and only the ones a value passes are tried, in
+    order. When only patterns are left they are joined into one regex that
+    picks the first match directly. Alternatives that can not be screened
+    are always tried, so results and errors are the same as `AnyOf`.
+
+        class ref(Union):
+            name = "ref"
+            schemas = ("branch", "commit")
+    """
+    schemas = ()
+    pure = True
+
+    def __init__(self, *schemas):
+        super(Union, self).__init__()
+        self._validators = map(parse, schemas or self.schemas)
+        self._screens = []
+        for validator in self._validators:
+            screen = SCREENS.get(getattr(type(validator).validate, "im_func", None))
+            self._screens.append(screen(validator) if screen else (None, None, None, None))
+        self._routes = {}
+
+    def validate(self, value, adapt=True):
+        try:
+            match, candidates = self._routes[type(value)]
+        except KeyError:
+            match, candidates = self._route(type(value))
+        start = 0
+        if match is not None:
+            found = match(value)
+            if found is None:
+                return self._fallback(value, adapt)
+            start = int(found.lastgroup[1:])
+            try:
+                return candidates[start][0].validate(value, adapt)
+            except ValidationError:
+                start += 1
+        for validator, check in candidates[start:]:
+            if check is None or check(value):
+                try:
+                    return validator.validate(value, adapt)
+                except ValidationError:
+                    pass
+        return self._fallback(value, adapt)
+
+    def _route(self, cls):
+        """Returns the combined regex match and the alternatives for values of type `cls`
+        """
+        candidates = []
+        for validator, (accept, reject, check, regexp) in zip(self._validators, self._screens):
+            if accept is not None and cls is not InstanceType and \
+               (not issubclass(cls, accept) or issubclass(cls, reject)):
+                continue
+            candidates.append((validator, check, regexp))
+
+        match = None
+        regexps = [regexp for _, _, regexp in candidates]
+        if len(regexps) > 1 and None not in regexps and len(set(r.flags for r in regexps)) == 1 \
+           and not any(r.groupindex or UNCOMBINABLE.search(r.pattern) for r in regexps):
+            match = re.compile("|".join("(?P<_%d>%s)" % (n, r.pattern) for n, r in enumerate(regexps)),
+                               regexps[0].flags).match
+
+        route = self._routes[cls] = (match, [(validator, check) for validator, check, _ in candidates])
+        return route
+
+    def _fallback(self, value, adapt):
+        # every alternative in turn, as AnyOf does, for the error message
+        messages = []
+        for validator in self._validators:
+            try:
+                return validator.validate(value, adapt)
+            except ValidationError as e:
+                messages.append(e.msg)
+        raise ValidationError(" or ".join(messages), value)
+
+    @property
+    def humanized_name(self):
+        return " or ".join(v.humanized_name for v in self._validators)
+
+
+class ref(Union):
     name = "ref"
-    validate = AnyOf("branch", "commit").validate
+    pure = True
+    schemas = ("branch", "commit")
 
 
 class version(Pattern):
     name = "version"
+    pure = True
     regexp = re.compile(r"^\d+\.\d+\.\d+$")
 
 
 class _callable(Validator):
     name = "callable"
+    pure = True
 
     def validate(self, value, adapt=True):
         if not callable(value):
@@ -146,10 +508,11 @@ class _callable(Validator):
 
 class date(Validator):
     name = "date"
+    pure = False
 
     def validate(self, value, adapt=True):
         try:
-            date = timestring.Date(value)
+            date = parse_date(value)
             return date if adapt else value
         except timestring.TimestringInvalid as e:
             self.error("invalid date provied, %s" % str(e))
@@ -157,10 +520,11 @@ class date(Validator):
 
 class date_past(Validator):
     name = "date-past"
+    pure = False
 
     def validate(self, value, adapt=True):
         try:
-            date = timestring.Date((value + " ago") if isinstance(value, (str, unicode)) else value)
+            date = timestring_cache.get(timestring.Date, (value + " ago") if isinstance(value, (str, unicode)) else value)
             return date if adapt else value
         except timestring.TimestringInvalid as e:
             self.error("invalid date provied, %s" % str(e))
@@ -168,10 +532,11 @@ class date_past(Validator):
 
 class range(Validator):
     name = "daterange"
+    pure = False
 
     def validate(self, value, adapt=True):
         try:
-            _range = timestring.Range(value)
+            _range = parse_range(value)
             return _range if adapt else value
         except timestring.TimestringInvalid:
             self.error("invalid date range provied")
@@ -179,6 +544,7 @@ class range(Validator):
 
 class day(String):
     name = "day"
+    pure = True
 
     def validate(self, value, adapt=True):
         super(day, self).validate(str(value))
@@ -194,6 +560,7 @@ class day(String):
 
 class rangetz(Validator):
     name = "daterangetz"
+    pure = False
 
     def validate(self, value, adapt=True):
         try:
@@ -201,22 +568,24 @@ class rangetz(Validator):
                 if value.tz is None:
                     value.tz = "UTC"
                 return value
-            return timestring.Range(value, tz="UTC")
+            return parse_range(value, tz="UTC")
         except timestring.TimestringInvalid:
             self.error("Invalid range provied")
 
 
 class elapse(String):
     name = "elapse"
+    pure = False
 
     def validate(self, value, adapt=True):
         super(elapse, self).validate(str(value))
-        return str(len(timestring.Range(value)))
+        return str(len(parse_range(value)))
 
 
 class _float(Validator):
     name = "float"
-    regexp = re.compile(r"\-?\d+(\,\d{3})*(\.\d+)?(k|m)?")
+    pure = True
+    regexp = re.compile(r"^\-?\d+(\,\d{3})*(\.\d+)?(k|m)?$")
 
     def validate(self, value, adapt=True):
         if type(value) in (float, int, long):
@@ -229,7 +598,7 @@ class _float(Validator):
         if x > 1:
             value = value[:-1]
         try:
-            value = float(value) * x
+            value = float(value.replace(",", "")) * x
             return value
         except ValueError:
             self.error("Value must be a valid number")
@@ -237,6 +606,7 @@ class _float(Validator):
 
 class integar(String):
     name = "int"
+    pure = True
     regexp = re.compile(r"^(\d+(\.\d+)?\%|(\-?\d+(\,\d{3})*(\.\d+)?(k|m)?))$")
 
     def validate(self, value, adapt=True):
@@ -252,33 +622,119 @@ class integar(String):
         if value.endswith('%'):
             return value
         try:
-            return int(float(value) * x)
+            return int(float(value.replace(",", "")) * x)
         except ValueError:
             self.error("Value must be a valid number")
 
 
+class _numbers(Validator):
+    """Comma separated (?ids=1,2,3) or repeated (?ids=1&ids=2) numbers
+    returned as an `array.array`, or a numpy array with `numpy=True`
+
+    Plain numbers are checked with one regex over the whole list and
+    converted in one pass, anything else (ex. 5k or 1.5m) is validated
+    item by item. Thousands separators only apply to repeated arguments
+    as commas split the items of a single one.
+    """
+    def __init__(self, max_length=None, numpy=False):
+        super(_numbers, self).__init__()
+        assert not numpy or globals()["numpy"], "numpy is not installed"
+        self.max_length = max_length
+        self.numpy = numpy
+
+    def validate(self, value, adapt=True):
+        if type(value) in (str, unicode):
+            text, items = value, value.split(",")
+        elif isinstance(value, (list, tuple)):
+            text, items = None, value
+        else:
+            self.error("invalid type")
+
+        if self.max_length is not None and len(items) > self.max_length:
+            self.error("must contain at most %d elements" % self.max_length)
+
+        if text is None:
+            if all(type(item) in self.types for item in items):
+                return self._result(items, None) if adapt else value
+            text = ",".join(item if type(item) in (str, unicode) else str(item) for item in items)
+            if text.count(",") != len(items) - 1:
+                # an item holds a comma, ex. 1,000
+                text = None
+
+        if text is not None and self.plain.match(text):
+            numbers = None
+        else:
+            numbers = []
+            for index, item in enumerate(items):
+                try:
+                    number = self.item.validate(item)
+                except ValidationError as e:
+                    raise e.add_context(index)
+                if type(number) not in self.types:
+                    # ex. percents
+                    self.error("invalid number at %d" % index)
+                numbers.append(number)
+        return self._result(numbers, text) if adapt else value
+
+    def _result(self, numbers, text):
+        if numbers is None:
+            # plain numbers
+            if self.numpy:
+                return numpy.fromstring(text, dtype=self.dtype, sep=",")
+            numbers = map(self.cast, text.split(","))
+        if self.numpy:
+            return numpy.array(numbers, dtype=self.dtype)
+        try:
+            return array(self.typecode, numbers)
+        except OverflowError:
+            self.error("number out of range")
+
+
+class integars(_numbers):
+    name = "ints"
+    pure = True
+    typecode, dtype, cast = "l", "int64", int
+    types = (int, )
+    plain = re.compile(r"^-?\d+(,-?\d+)*$")
+    item = integar()
+
+
+class floats(_numbers):
+    name = "floats"
+    pure = True
+    typecode, dtype, cast = "d", "float64", float
+    types = (float, int)
+    plain = re.compile(r"^-?\d+(\.\d+)?(,-?\d+(\.\d+)?)*$")
+    item = _float()
+
+
 class cc_name(Pattern):
     name = "cc_name"
+    pure = True
     regexp = re.compile(r"^.{1,50}$")
 
 
 class cc_cvv(Pattern):
     name = "cc_cvv"
+    pure = True
     regexp = re.compile(r"^\d{3,4}$")
 
 
 class cc_exp_month(Pattern):
     name = "cc_exp_month"
+    pure = True
     regexp = re.compile(r"^\d{1,2}$")
 
 
 class cc_exp_year(Pattern):
     name = "cc_exp_year"
+    pure = True
     regexp = re.compile(r"^\d{4}$")
 
 
 class cc_number(Pattern):
     name = 'cc_number'
+    pure = True
     regexp = re.compile(r"^\d{4}(\-|\s)?\d{4}(\-|\s)?\d{4}(\-|\s)?\d{2,4}$")
     replace = re.compile(r"[\D]")
 